@@ -1,9 +1,10 @@
 import streamlit as st
-import geopandas as gpd
 import pandas as pd
 import matplotlib.pyplot as plt
-from matplotlib.patches import Patch
-from matplotlib.colors import ListedColormap, to_hex
+from matplotlib.colors import to_hex
+from boundaries import boundary_layer
+from choropleth import chiefdom_canvas, class_codes, merge_chiefdom_data
+from ingest import read_excel, upload_columns
 
 # Streamlit app title and image
 st.title("Map Generator")
@@ -14,20 +15,23 @@ uploaded_file = st.file_uploader("Upload an Excel file", type=["xlsx"])
 
 # Check if the file has been uploaded
 if uploaded_file is not None:
-    # Load the uploaded Excel file
-    df = pd.read_excel(uploaded_file)
-
-    # Load shapefile data
-    gdf = gpd.read_file("https://raw.githubusercontent.com/mohamedsillahkanu/si/2b7f982174b609f9647933147dec2a59a33e736a/Chiefdom%202021.shp")
+    # Load shapefile data (once per process, with its boundaries, label points
+    # and simplified levels of detail)
+    boundaries = boundary_layer()
 
     # Automatically select the columns "FIRST_DNAM" and "FIRST_CHIE"
     shapefile_columns = ["FIRST_DNAM", "FIRST_CHIE"]
 
-    # Filter out "FIRST_DNAM", "FIRST_CHIE", and "adm3" from df columns for map_column selection
-    df_columns_filtered = [col for col in df.columns if col not in ["FIRST_DNAM", "FIRST_CHIE", "adm3"]]
+    # Filter out "FIRST_DNAM", "FIRST_CHIE", and "adm3" from the uploaded columns for map_column selection
+    df_columns_filtered = [col for col in upload_columns(uploaded_file) if col not in ["FIRST_DNAM", "FIRST_CHIE", "adm3"]]
 
     # User input for the map column and settings
     map_column = st.selectbox("Select Map Column:", df_columns_filtered)
+
+    # Load the uploaded Excel file, only the columns the maps use (parsed once
+    # per upload and column, then from memory on reruns)
+    df = read_excel(uploaded_file, columns=shapefile_columns + [map_column])
+
     map_title = st.text_input("Map Title:")
     legend_title = st.text_input("Legend Title:")
     image_name = st.text_input("Image Name:", value="map_image")
@@ -96,85 +100,54 @@ if uploaded_file is not None:
 
     if st.button("Generate Map"):
         try:
+            # Draw the simplest level of detail that looks the same on the
+            # 12x12 figures saved at 300 dpi
+            view = boundaries.level_for((12, 12), 300)
+
             # Merge the shapefile and Excel data based on the selected columns
-            merged_gdf = gdf.merge(df, left_on=shapefile_columns, right_on=shapefile_columns, how='left')
+            merged_gdf, positions = merge_chiefdom_data(view.chiefdoms, df, shapefile_columns, shapefile_columns)
 
             if map_column not in merged_gdf.columns:
                 st.error(f"The column '{map_column}' does not exist in the merged dataset.")
             else:
-                # Plot the general map with the legend
-                fig, ax = plt.subplots(1, 1, figsize=(12, 12))
-                
                 # Set default line color and width
                 boundary_color = line_color.lower()
                 boundary_width = line_width
-                
-                # Plot boundaries with the selected line width
-                merged_gdf.boundary.plot(ax=ax, edgecolor=boundary_color, linewidth=boundary_width)
-                
-                # Apply custom colors if specified
-                custom_cmap = ListedColormap([color_mapping.get(cat, missing_value_color.lower()) for cat in selected_categories])
-                
-                # Plot the map data with categories
-                merged_gdf.plot(column=map_column, ax=ax, linewidth=boundary_width, edgecolor=boundary_color, cmap=custom_cmap,
-                                legend=False, missing_kwds={'color': missing_value_color.lower(), 'edgecolor': boundary_color, 'label': missing_value_label})
-                
-                ax.set_title(f"{map_title} (General Map)", fontsize=font_size, fontweight='bold')
-                ax.set_axis_off()
-                
-                # Create legend handles with category counts
-                handles = []
-                for cat in selected_categories:
-                    label_with_count = f"{cat} ({category_counts.get(cat, 0)})"
-                    handles.append(Patch(color=color_mapping.get(cat, missing_value_color.lower()), label=label_with_count))
-                
-                handles.append(Patch(color=missing_value_color.lower(), label=f"{missing_value_label} ({df[map_column].isna().sum()})"))
-                
-                ax.legend(handles=handles, title=legend_title, bbox_to_anchor=(1.05, 1), loc='upper left')
-                
-                # Save or display the general map
-                general_map_path = f"/tmp/{image_name}_general.png"
-                plt.savefig(general_map_path, dpi=300, bbox_inches='tight')
-                st.image(general_map_path, caption="General Map", use_column_width=True)
-                plt.close(fig)
-
-                # Plot each unique `FIRST_DNAM` separately
+                missing_color = missing_value_color.lower()
+
+                # Custom colors of the categories, and legend entries with category counts
+                category_colors = [color_mapping.get(cat, missing_color) for cat in selected_categories]
+                handles = [(color, f"{cat} ({category_counts.get(cat, 0)})")
+                           for cat, color in zip(selected_categories, category_colors)]
+                legend_kwargs = {'bbox_to_anchor': (1.05, 1), 'loc': 'upper left'}
+
+                # The chiefdom polygons are drawn once per boundary level and
+                # district, then only recolored for each map
+                codes = class_codes(merged_gdf[map_column], selected_categories, positions, len(view.chiefdoms))
+                general_map = chiefdom_canvas(view, figsize=(12, 12)).render(
+                    codes, category_colors, missing_color, boundary_color, boundary_width,
+                    title=f"{map_title} (General Map)", title_size=font_size,
+                    legend=handles + [(missing_color, f"{missing_value_label} ({df[map_column].isna().sum()})")],
+                    legend_title=legend_title, legend_kwargs=legend_kwargs, dpi=300)
+                st.image(general_map, caption="General Map", use_column_width=True)
+
+                # Plot each unique `FIRST_DNAM` separately, with its chiefdoms labelled
                 first_dnam_values = merged_gdf['FIRST_DNAM'].unique()
 
                 for value in first_dnam_values:
-                    fig, ax = plt.subplots(1, 1, figsize=(12, 12))
-                    subset_gdf = merged_gdf[merged_gdf['FIRST_DNAM'] == value]
-
-                    # Set default line color and width for subset
-                    subset_boundary_color = line_color.lower()
-                    subset_boundary_width = line_width
-
-                    subset_gdf.boundary.plot(ax=ax, edgecolor=subset_boundary_color, linewidth=subset_boundary_width)
-                    subset_gdf.plot(column=map_column, ax=ax, linewidth=subset_boundary_width, edgecolor=subset_boundary_color, cmap=custom_cmap,
-                                    legend=False, missing_kwds={'color': missing_value_color.lower(), 'edgecolor': subset_boundary_color, 'label': missing_value_label})
-
-                    # Add text labels for each `FIRST_CHIE`
-                    for idx, row in subset_gdf.iterrows():
-                        ax.text(row.geometry.centroid.x, row.geometry.centroid.y, row['FIRST_CHIE'], fontsize=10, ha='center', color='black')
-
-                    ax.set_title(f"{map_title} - {value}", fontsize=font_size, fontweight='bold')
-                    ax.set_axis_off()
-
-                    # Create legend handles with category counts
-                    handles = []
-                    for cat in selected_categories:
-                        label_with_count = f"{cat} ({category_counts.get(cat, 0)})"
-                        handles.append(Patch(color=color_mapping.get(cat, missing_value_color.lower()), label=label_with_count))
-
-                    handles.append(Patch(color=missing_value_color.lower(), label=f"{missing_value_label} ({subset_gdf[map_column].isna().sum()})"))
-
-                    ax.legend(handles=handles, title=legend_title, bbox_to_anchor=(1.05, 1), loc='upper left')
-
-                    # Save or display each subplot
-                    subplot_path = f"/tmp/{image_name}_{value}.png"
-                    plt.savefig(subplot_path, dpi=300, bbox_inches='tight')
-                    st.image(subplot_path, caption=f"{map_title} - {value}", use_column_width=True)
-                    plt.close(fig)
+                    district_view = boundaries.level_for((12, 12), 300, boundaries.district_extents[value])
+                    district_chiefdoms = district_view.chiefdoms.iloc[district_view.district_rows[value]]
+                    subset_gdf, subset_positions = merge_chiefdom_data(district_chiefdoms, df, shapefile_columns,
+                                                                       shapefile_columns)
+
+                    codes = class_codes(subset_gdf[map_column], selected_categories, subset_positions,
+                                        len(district_chiefdoms))
+                    subplot = chiefdom_canvas(district_view, figsize=(12, 12), district=value).render(
+                        codes, category_colors, missing_color, boundary_color, boundary_width,
+                        [(boundary_color, boundary_width)], f"{map_title} - {value}", font_size,
+                        handles + [(missing_color, f"{missing_value_label} ({subset_gdf[map_column].isna().sum()})")],
+                        legend_title, legend_kwargs, dpi=300)
+                    st.image(subplot, caption=f"{map_title} - {value}", use_column_width=True)
         except Exception as e:
             st.error(f"An error occurred while generating the map: {e}")
 else:
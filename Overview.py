@@ -1,7 +1,6 @@
 import streamlit as st
-import requests
 from PIL import Image
-from io import BytesIO
+from asset_cache import SIERRA_LEONE_MAP_URL, asset_path
 
 # Title of the app
 st.title("Automated Geospatial Analysis for Sub-National Tailoring of Malaria Interventions")
@@ -9,23 +8,19 @@ st.title("Automated Geospatial Analysis for Sub-National Tailoring of Malaria In
 # Function to load and display image with error handling
 def load_and_display_image(image_url):
     try:
-        response = requests.get(image_url)
-        if response.status_code == 200:
-            image = Image.open(BytesIO(response.content))
-            st.image(
-                image,
-                caption="Sierra Leone Administrative Map",
-                use_column_width=True
-            )
-        else:
-            st.error(f"Failed to load image. Status code: {response.status_code}")
+        # Downloaded once into the local asset cache, then read from disk
+        image = Image.open(asset_path(image_url))
+        st.image(
+            image,
+            caption="Sierra Leone Administrative Map",
+            use_column_width=True
+        )
     except Exception as e:
         st.error(f"Error loading image: {str(e)}")
         st.info("Please ensure the image URL is accessible and valid.")
 
 # Display the image using the GitHub raw URL with error handling
-image_url = "https://github.com/mohamedsillahkanu/si/raw/b0706926bf09ba23d8e90c394fdbb17e864121d8/Sierra%20Leone%20Map.png"
-load_and_display_image(image_url)
+load_and_display_image(SIERRA_LEONE_MAP_URL)
 
 # Overview Section
 st.header("Overview")
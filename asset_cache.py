@@ -0,0 +1,195 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+from datetime import datetime, timezone
+from functools import lru_cache
+from urllib.parse import unquote, urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Where downloaded assets are kept, and whether to skip the network altogether
+DEFAULT_CACHE_DIR = os.environ.get('NMCP_ASSET_CACHE_DIR', os.path.join(APP_DIR, '.asset_cache'))
+OFFLINE = os.environ.get('NMCP_OFFLINE', '').lower() in ('1', 'true', 'yes')
+
+CHIEFDOM_SHAPEFILE_URL = ("https://raw.githubusercontent.com/mohamedsillahkanu/si/"
+                          "2b7f982174b609f9647933147dec2a59a33e736a/Chiefdom%202021.shp")
+SIERRA_LEONE_MAP_URL = ("https://github.com/mohamedsillahkanu/si/raw/"
+                        "b0706926bf09ba23d8e90c394fdbb17e864121d8/Sierra%20Leone%20Map.png")
+
+# Copies shipped with the app, used offline or when a download fails
+BUNDLED_ASSETS = {
+    CHIEFDOM_SHAPEFILE_URL: os.path.join(APP_DIR, 'Chiefdom 2021.shp'),
+}
+
+# Files that travel with a .shp: required ones, then optional ones
+SHAPEFILE_COMPANIONS = ('.shx', '.dbf')
+SHAPEFILE_OPTIONAL_COMPANIONS = ('.prj', '.cpg')
+
+
+class AssetUnavailable(Exception):
+    """Raised when an asset is neither cached, bundled nor downloadable."""
+
+
+class AssetCache:
+    """Local, content-addressed copies of remote files.
+
+    Every asset is downloaded once into cache_dir/<sha256 of its content>/,
+    keeping its file name so companions such as a shapefile's .shx and .dbf
+    sit next to it. index.json maps each URL to its copy. The app's URLs are
+    pinned to a commit, so a cached copy never goes stale and later lookups
+    never touch the network; within a process they are a dict lookup.
+
+    Offline, or when a download fails, assets listed in BUNDLED_ASSETS
+    resolve to the copy shipped with the app.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, offline=OFFLINE, timeout=(5, 60), session=None):
+        self.cache_dir = cache_dir
+        self.offline = offline
+        self.timeout = timeout
+        self._session = session
+        self._resolved = {}
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        """HTTP session with pooled connections and retries on server errors, created on first use."""
+        if self._session is None:
+            retry = Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=retry)
+            self._session = requests.Session()
+            self._session.mount('https://', adapter)
+            self._session.mount('http://', adapter)
+        return self._session
+
+    @property
+    def index_path(self):
+        return os.path.join(self.cache_dir, 'index.json')
+
+    def read_index(self):
+        try:
+            with open(self.index_path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def write_index(self, index):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.json')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(index, f, indent=2)
+        os.replace(tmp_path, self.index_path)
+
+    def path(self, url, companions=(), optional_companions=()):
+        """Return the local path of the file at url, downloading it on first use.
+
+        companions are extensions of files stored next to it under the same
+        name (e.g. '.dbf' for a shapefile); optional_companions may be missing
+        on the server.
+        """
+        resolved = self._resolved.get(url)
+        if resolved is not None:
+            return resolved
+        with self._lock:
+            if url not in self._resolved:
+                self._resolved[url] = self._resolve(url, companions, optional_companions)
+            return self._resolved[url]
+
+    def shapefile(self, url):
+        """Return the local path of a remote .shp, with its .shx, .dbf (and .prj, .cpg) next to it."""
+        return self.path(url, SHAPEFILE_COMPANIONS, SHAPEFILE_OPTIONAL_COMPANIONS)
+
+    def _resolve(self, url, companions, optional_companions):
+        entry = self.read_index().get(url)
+        if entry is not None:
+            cached = os.path.join(self.cache_dir, entry['path'])
+            if os.path.exists(cached):
+                return cached
+
+        bundled = BUNDLED_ASSETS.get(url)
+        if self.offline:
+            if bundled is None:
+                raise AssetUnavailable(f"{url} is not cached and there is no bundled copy (offline mode)")
+            return bundled
+        try:
+            return self._download(url, companions, optional_companions)
+        except (requests.RequestException, OSError) as e:
+            if bundled is None:
+                raise AssetUnavailable(f"Could not download {url}: {e}") from e
+            return bundled
+
+    def _fetch(self, url, destination, required=True):
+        """Stream url into destination; returns False for a missing optional file."""
+        with self.session.get(url, timeout=self.timeout, stream=True) as response:
+            if response.status_code == 404 and not required:
+                return False
+            response.raise_for_status()
+            with open(destination, 'wb') as f:
+                for block in response.iter_content(chunk_size=1 << 16):
+                    f.write(block)
+        return True
+
+    def _download(self, url, companions, optional_companions):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        base_url = os.path.splitext(url)[0]
+        name = unquote(os.path.basename(urlsplit(url).path))
+        stem = os.path.splitext(name)[0]
+
+        staging = tempfile.mkdtemp(dir=self.cache_dir, prefix='.download-')
+        try:
+            self._fetch(url, os.path.join(staging, name))
+            for companion in companions:
+                self._fetch(base_url + companion, os.path.join(staging, stem + companion))
+            for companion in optional_companions:
+                self._fetch(base_url + companion, os.path.join(staging, stem + companion), required=False)
+
+            # The directory is named after the content of all its files
+            digest = hashlib.sha256()
+            for file_name in sorted(os.listdir(staging)):
+                digest.update(file_name.encode())
+                with open(os.path.join(staging, file_name), 'rb') as f:
+                    for block in iter(lambda: f.read(1 << 20), b''):
+                        digest.update(block)
+            content_dir = os.path.join(self.cache_dir, digest.hexdigest())
+            try:
+                os.replace(staging, content_dir)
+            except OSError:
+                # Same content cached already (possibly by another process just now)
+                if not os.path.isdir(content_dir):
+                    raise
+                shutil.rmtree(staging)
+        except BaseException:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+
+        index = self.read_index()
+        index[url] = {
+            'path': os.path.join(digest.hexdigest(), name),
+            'sha256': digest.hexdigest(),
+            'fetched_at': datetime.now(timezone.utc).isoformat(timespec='seconds')
+        }
+        self.write_index(index)
+        return os.path.join(content_dir, name)
+
+
+@lru_cache(maxsize=None)
+def default_asset_cache():
+    """The AssetCache shared by the whole app process."""
+    return AssetCache()
+
+
+def asset_path(url):
+    """Local path of a remote file, through the shared cache."""
+    return default_asset_cache().path(url)
+
+
+def chiefdom_shapefile_path():
+    """Local path of the chiefdom boundaries shapefile, through the shared cache."""
+    return default_asset_cache().shapefile(CHIEFDOM_SHAPEFILE_URL)
@@ -0,0 +1,308 @@
+"""Benchmark the speed and accuracy of health facility name matching.
+
+Runs calculate_match on synthetic MFL/DHIS2 lists with Sierra Leone-style
+name corruptions (abbreviations, typos, facility-type changes) and on the
+small hand-labeled set in name_matching_ground_truth.csv, for every scorer
+and blocking strategy. Wall time, peak memory, name pairs scored per second,
+precision and recall are written to a JSON file, which can be passed back
+as --baseline to a later run to see what a change did.
+
+Example:
+    python benchmark_name_matching.py --sizes 1000 10000 -o before.json
+    python benchmark_name_matching.py --sizes 1000 10000 -o after.json --baseline before.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+from name_matching import SCORERS, MatchingEngine, calculate_match
+
+GROUND_TRUTH_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'name_matching_ground_truth.csv')
+
+DISTRICTS = ['Bo', 'Bombali', 'Bonthe', 'Falaba', 'Kailahun', 'Kambia', 'Karene', 'Kenema', 'Koinadugu', 'Kono',
+             'Moyamba', 'Port Loko', 'Pujehun', 'Tonkolili', 'Western Area Rural', 'Western Area Urban']
+
+# Building blocks of place names such as Ngiehun, Kpetema or Gbendembu
+ONSETS = ['', 'b', 'd', 'f', 'g', 'h', 'j', 'k', 'l', 'm', 'n', 's', 't', 'w', 'y',
+          'gb', 'kp', 'mb', 'nd', 'ng', 'nj']
+VOWELS = ['a', 'e', 'i', 'o', 'u', 'ie', 'ei', 'ua']
+ENDINGS = ['', '', 'hun', 'ma', 'ta', 'bu', 'la', 'wo', 'ya', 'ru', 'kor']
+
+# Facility types as (usual DHIS2 spelling, MFL variants)
+FACILITY_TYPES = [
+    ('CHC', ['Community Health Centre', 'CHC', 'C.H.C']),
+    ('CHP', ['Community Health Post', 'CHP', 'MCHP']),
+    ('MCHP', ['Maternal and Child Health Post', 'MCHP', 'CHP', 'M.C.H.P']),
+    ('Hospital', ['Hosp', 'Hosp.', 'Hospital']),
+    ('Government Hospital', ['Govt Hospital', 'Govt. Hosp', 'Gov Hospital']),
+    ('Clinic', ['Clin', 'Clinic', 'Health Clinic']),
+]
+TYPE_WEIGHTS = [0.2, 0.3, 0.35, 0.05, 0.05, 0.05]
+
+# Strategies compared for every scorer: calculate_match keyword arguments
+BLOCKING_STRATEGIES = {
+    'none': {},
+    'district': {'block_on': [('district', 'district')], 'national_fallback': False},
+    'district+fallback': {'block_on': [('district', 'district')], 'national_fallback': True},
+}
+
+
+def place_name(rng):
+    """Make up a Sierra Leone-style place name."""
+    syllables = ''.join(rng.choice(ONSETS) + rng.choice(VOWELS) for _ in range(rng.randint(1, 3)))
+    return (syllables + rng.choice(ENDINGS)).capitalize()
+
+
+def typo(word, rng):
+    """Delete, insert, substitute or swap one letter of a word."""
+    if len(word) < 3:
+        return word
+    i = rng.randrange(1, len(word) - 1)
+    kind = rng.choice(['delete', 'insert', 'substitute', 'swap'])
+    if kind == 'delete':
+        return word[:i] + word[i + 1:]
+    if kind == 'insert':
+        return word[:i] + rng.choice('aeiounr') + word[i:]
+    if kind == 'substitute':
+        return word[:i] + rng.choice('aeiounr') + word[i + 1:]
+    return word[:i] + word[i + 1] + word[i] + word[i + 2:]
+
+
+def corrupt_name(place, type_index, rng):
+    """Write a facility the way it might appear in the MFL, with one or two corruptions."""
+    type_name = rng.choice(FACILITY_TYPES[type_index][1])
+    words = place.split()
+    corruptions = rng.sample(['typo', 'type', 'case', 'punctuation'], rng.choice([1, 1, 2]))
+    if 'typo' in corruptions:
+        i = rng.randrange(len(words))
+        words[i] = typo(words[i], rng)
+    if 'type' in corruptions:
+        # Type left out or written first
+        if rng.random() < 0.5:
+            return ' '.join(words)
+        words, type_name = [type_name] + words, ''
+    name = ' '.join(words + [type_name]).strip()
+    if 'case' in corruptions:
+        name = name.upper() if rng.random() < 0.5 else name.lower()
+    if 'punctuation' in corruptions:
+        name = name.replace(' ', rng.choice(['  ', '-', ' - ']), 1) if ' ' in name else name + '.'
+    return name
+
+
+def make_benchmark_lists(n, seed=0, unmatched_share=0.1):
+    """Return synthetic (mfl, dhis2) lists of n facilities each.
+
+    Both have 'name' and 'district' columns. Most MFL names are corrupted
+    copies of a DHIS2 name; unmatched_share of them are facilities missing
+    from DHIS2. The MFL column 'true_name' holds the DHIS2 name each row
+    should match, or None.
+    """
+    rng = random.Random(seed)
+    facilities = {}
+    while len(facilities) < 2 * n:
+        # Larger facilities sometimes carry a second place name
+        place = place_name(rng) if rng.random() < 0.8 else place_name(rng) + ' ' + place_name(rng)
+        type_index = rng.choices(range(len(FACILITY_TYPES)), TYPE_WEIGHTS)[0]
+        name = place + ' ' + FACILITY_TYPES[type_index][0]
+        facilities.setdefault(name, (place, type_index, rng.choice(DISTRICTS)))
+    names = list(facilities)
+    dhis2_names, missing_names = names[:n], names[n:]
+
+    rows = []
+    n_missing = int(round(n * unmatched_share))
+    for name in rng.sample(dhis2_names, n - n_missing):
+        place, type_index, district = facilities[name]
+        rows.append((corrupt_name(place, type_index, rng), district, name))
+    for name in missing_names[:n_missing]:
+        place, type_index, district = facilities[name]
+        rows.append((corrupt_name(place, type_index, rng), district, None))
+    rng.shuffle(rows)
+
+    mfl = pd.DataFrame(rows, columns=['name', 'district', 'true_name'])
+    dhis2 = pd.DataFrame({'name': dhis2_names, 'district': [facilities[name][2] for name in dhis2_names]})
+    return mfl, dhis2
+
+
+def load_ground_truth(path=GROUND_TRUTH_PATH):
+    """Return the hand-labeled (mfl, dhis2) lists, shaped like make_benchmark_lists."""
+    labels = pd.read_csv(path, dtype=str)
+    labels = labels.astype(object).where(labels.notna(), None)
+    in_mfl = labels['mfl_name'].notna()
+    mfl = pd.DataFrame({
+        'name': labels.loc[in_mfl, 'mfl_name'],
+        'district': labels.loc[in_mfl, 'district'],
+        'true_name': labels.loc[in_mfl, 'dhis2_name']
+    }).reset_index(drop=True)
+    in_dhis2 = labels['dhis2_name'].notna()
+    dhis2 = pd.DataFrame({
+        'name': labels.loc[in_dhis2, 'dhis2_name'],
+        'district': labels.loc[in_dhis2, 'district']
+    }).reset_index(drop=True)
+    return mfl, dhis2
+
+
+def accuracy(results, true_names):
+    """Precision and recall of the matches in calculate_match results against the true DHIS2 names.
+
+    A match to the right facility is a true positive; a match to the wrong
+    one counts as both a false positive and a false negative.
+    """
+    # The first rows of the results are the MFL rows, in order
+    results = results.iloc[:len(true_names)]
+    matched = (results['Match_Status'] == 'Match').to_numpy()
+    predicted = results['HF_Name_in_DHIS2'].to_numpy(dtype=object)
+    true_names = np.asarray(true_names, dtype=object)
+    has_partner = pd.notna(true_names)
+    correct = matched & has_partner & (predicted == true_names)
+    tp = int(correct.sum())
+    fp = int((matched & ~correct).sum())
+    fn = int((has_partner & ~correct).sum())
+    return {
+        'precision': tp / (tp + fp) if tp + fp else 1.0,
+        'recall': tp / (tp + fn) if tp + fn else 1.0,
+        'true_positives': tp,
+        'false_positives': fp,
+        'false_negatives': fn,
+    }
+
+
+def match_case(mfl, dhis2, scorer, blocking, threshold, normalize, engine_options):
+    """Run calculate_match for one benchmark case."""
+    engine = MatchingEngine(scorer=scorer, **engine_options)
+    return calculate_match(mfl, dhis2, 'name', 'name', threshold, engine=engine, normalize=normalize,
+                           **BLOCKING_STRATEGIES[blocking])
+
+
+def peak_memory_of_case(*case_args):
+    """Match one case and return how far it raised the peak resident memory of this process, in MB."""
+    import resource
+
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    match_case(*case_args)
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return (after - before) / (2 ** 20 if sys.platform == 'darwin' else 2 ** 10)
+
+
+def run_case(mfl, dhis2, scorer, blocking, threshold, normalize, engine_options, repeat=1, measure_memory=True):
+    """Match one pair of lists with one scorer and blocking strategy and return its measurements.
+
+    Peak memory is measured in a separate run in a fresh process, since the
+    peak of this one never goes down between cases. It is the memory matching
+    adds on top of the loaded lists, and leaves out worker processes.
+    """
+    case_args = (mfl, dhis2, scorer, blocking, threshold, normalize, engine_options)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        results = match_case(*case_args)
+        times.append(time.perf_counter() - start)
+    wall_time = min(times)
+
+    peak_memory_mb = None
+    if measure_memory:
+        try:
+            with ProcessPoolExecutor(1) as pool:
+                peak_memory_mb = pool.submit(peak_memory_of_case, *case_args).result()
+        except ImportError:
+            # No resource module (Windows)
+            pass
+
+    # Only the pairs that went through the scorer: blocking and exact
+    # matches leave most of the full cross product out
+    pairs_scored = results.attrs['pairs_scored']
+    return dict(
+        n_mfl=len(mfl),
+        n_dhis2=len(dhis2),
+        wall_time_s=wall_time,
+        peak_memory_mb=peak_memory_mb,
+        pairs_scored=pairs_scored,
+        pairs_per_s=pairs_scored / max(wall_time, 1e-9),
+        **accuracy(results, mfl['true_name'])
+    )
+
+
+def case_key(case):
+    return case['dataset'], case['n_names'], case['scorer'], case['blocking']
+
+
+def compare_runs(baseline, current):
+    """Print how every case of the current run changed against the baseline run."""
+    previous = {case_key(case): case for case in baseline['cases']}
+    print(f"\nChanges against the baseline from {baseline['created_at']}:")
+    for case in current['cases']:
+        old = previous.get(case_key(case))
+        if old is None:
+            continue
+        dataset, n_names, scorer, blocking = case_key(case)
+        print(f"  {dataset:<12} {n_names:>6} {scorer:<12} {blocking:<18} "
+              f"time x{case['wall_time_s'] / max(old['wall_time_s'], 1e-9):.2f}  "
+              f"precision {case['precision'] - old['precision']:+.3f}  "
+              f"recall {case['recall'] - old['recall']:+.3f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark health facility name matching.")
+    parser.add_argument('-o', '--output', default='name_matching_benchmark.json', help="JSON results file")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 50000],
+                        help="Synthetic list sizes to run (default: 1000 10000 50000)")
+    parser.add_argument('--scorers', nargs='+', choices=sorted(SCORERS), default=sorted(SCORERS))
+    parser.add_argument('--blocking', nargs='+', choices=list(BLOCKING_STRATEGIES), default=list(BLOCKING_STRATEGIES))
+    parser.add_argument('--threshold', type=float, default=70, help="Match threshold, 0-100 (default: 70)")
+    parser.add_argument('--normalize', action='store_true', help="Normalize names before matching")
+    parser.add_argument('--top-k', type=int, default=0, help="Candidates per name from the n-gram index (0 = all)")
+    parser.add_argument('--processes', type=int, default=0, help="Worker processes for scoring (0 = none)")
+    parser.add_argument('--max-memory-mb', type=int, default=512, help="Memory limit for score matrices")
+    parser.add_argument('--repeat', type=int, default=1, help="Timed runs per case; the fastest counts")
+    parser.add_argument('--no-memory', action='store_true', help="Skip the extra run for peak memory")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the synthetic lists")
+    parser.add_argument('--baseline', help="Earlier results file to compare with")
+    args = parser.parse_args(argv)
+
+    engine_options = dict(top_k=args.top_k or None, processes=args.processes or None,
+                          max_memory_mb=args.max_memory_mb)
+    datasets = [('ground_truth', load_ground_truth())]
+    datasets += [('synthetic', make_benchmark_lists(n, args.seed)) for n in args.sizes]
+
+    run = {
+        'created_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'settings': dict(threshold=args.threshold, normalize=args.normalize, seed=args.seed,
+                         repeat=args.repeat, **engine_options),
+        'cases': []
+    }
+    for dataset, (mfl, dhis2) in datasets:
+        for scorer in args.scorers:
+            for blocking in args.blocking:
+                case = dict(dataset=dataset, n_names=len(mfl), scorer=scorer, blocking=blocking)
+                case.update(run_case(mfl, dhis2, scorer, blocking, args.threshold, args.normalize, engine_options,
+                                     args.repeat, not args.no_memory))
+                run['cases'].append(case)
+                memory = f"{case['peak_memory_mb']:8.1f} MB" if case['peak_memory_mb'] is not None else ''
+                print(f"{dataset:<12} {len(mfl):>6} {scorer:<12} {blocking:<18} "
+                      f"{case['wall_time_s']:8.2f}s {case['pairs_per_s']:>14,.0f} pairs/s {memory}  "
+                      f"precision {case['precision']:.3f}  recall {case['recall']:.3f}")
+
+    with open(args.output, 'w') as f:
+        json.dump(run, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare_runs(json.load(f), run)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,371 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import unicodedata
+from collections import OrderedDict
+from datetime import datetime, timezone
+from functools import cached_property, lru_cache
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+from shapely import STRtree
+
+from asset_cache import chiefdom_shapefile_path
+
+# Name columns of the chiefdom shapefile
+DISTRICT_COL = 'FIRST_DNAM'
+CHIEFDOM_COL = 'FIRST_CHIE'
+
+# Boundary packs: a directory of GeoParquet files next to the source file
+PACK_SUFFIX = '.boundarypack'
+PACK_FORMAT_VERSION = 2
+# Files that make up a shapefile, hashed to tell whether a pack is stale
+SOURCE_EXTENSIONS = ('.shp', '.shx', '.dbf', '.prj', '.cpg')
+
+# Simplification tolerances of the levels of detail used for rendering, in
+# map units (degrees for the chiefdom shapefile). Level 0 is the full geometry.
+LOD_TOLERANCES = (0.0, 0.0002, 0.001, 0.004)
+
+# Spatial indexes kept for boundary sets other than the app's own (uploads)
+MAX_CACHED_INDEXES = 8
+_indexes = OrderedDict()
+_indexes_lock = threading.Lock()
+
+
+def name_key(name):
+    """Normalized form of a district or chiefdom name, for joining on names spelled differently.
+
+    Accents, case, punctuation and repeated spaces are folded away, so
+    "Kailahun", "KAILAHUN " and "Kailahun." share one key.
+    """
+    if name is None or (isinstance(name, float) and np.isnan(name)):
+        return None
+    folded = unicodedata.normalize('NFKD', str(name)).encode('ascii', 'ignore').decode().casefold()
+    return ' '.join(re.sub(r'[^0-9a-z]+', ' ', folded).split())
+
+
+def simplify_coverage(frame, tolerance):
+    """Copy of a polygon GeoDataFrame with its geometries simplified together, as one coverage.
+
+    Unlike simplifying each polygon on its own, borders shared by two
+    polygons are simplified once, so neighbours stay aligned without gaps
+    or overlaps.
+    """
+    if not tolerance:
+        return frame
+    geometries = shapely.make_valid(frame.geometry.values)
+    if hasattr(shapely, 'coverage_simplify') and shapely.geos_version >= (3, 12, 0):
+        geometries = shapely.coverage_simplify(geometries, tolerance)
+    else:
+        # Shapely < 2.1 or GEOS < 3.12: polygons simplified one by one, so shared borders
+        # may drift apart by up to the tolerance (under a pixel at the level
+        # pick_tolerance chooses)
+        geometries = shapely.simplify(geometries, tolerance, preserve_topology=True)
+    simplified = frame.copy()
+    simplified[frame.geometry.name] = gpd.GeoSeries(geometries, index=frame.index, crs=frame.crs)
+    return simplified
+
+
+def pick_tolerance(extent, figsize, dpi, tolerances=LOD_TOLERANCES):
+    """Largest tolerance that stays within one pixel when extent is drawn on a figsize figure at dpi."""
+    minx, miny, maxx, maxy = extent
+    units_per_pixel = max((maxx - minx) / (figsize[0] * dpi), (maxy - miny) / (figsize[1] * dpi))
+    return max([tolerance for tolerance in tolerances if tolerance <= units_per_pixel] + [min(tolerances)])
+
+
+class SpatialIndex:
+    """STRtree over a set of polygons, prepared for locating many points at once."""
+
+    def __init__(self, geometries):
+        self.geometries = np.asarray(geometries)
+        shapely.prepare(self.geometries)
+        self.tree = STRtree(self.geometries)
+
+    def locate(self, points):
+        """Position of the polygon each point lies within, or -1 for points outside all of them.
+
+        One bounding-box query of every point followed by one vectorized test
+        against the prepared candidate polygons. A point within several
+        (overlapping) polygons goes to the first one; points on a border and
+        missing or empty points are outside, as with predicate="within".
+        """
+        points = np.asarray(points)
+        point_positions, polygon_positions = self.tree.query(points)
+        inside = shapely.contains(self.geometries[polygon_positions], points[point_positions])
+        point_positions, polygon_positions = point_positions[inside], polygon_positions[inside]
+        located = np.full(len(points), -1, dtype=np.intp)
+        points_found, first = np.unique(point_positions, return_index=True)
+        located[points_found] = polygon_positions[first]
+        return located
+
+
+def boundary_version(frame):
+    """Hash of the polygons of a GeoDataFrame, in row order, identifying a boundary set.
+
+    Frames tagged by tag_boundary_version reuse the hash stored with them.
+    """
+    tagged = frame.attrs.get('boundary_version')
+    # Only trusted while the frame keeps the rows and extent it was tagged
+    # with, so filtered or reprojected copies are hashed again
+    if tagged is not None and tagged[1:] == (len(frame), tuple(frame.total_bounds)):
+        return tagged[0]
+    geometries = np.asarray(frame.geometry.values)
+    return hashlib.sha256(b''.join(wkb or b'' for wkb in shapely.to_wkb(geometries))).hexdigest()
+
+
+def tag_boundary_version(frame):
+    """frame with its boundary_version stored in frame.attrs (kept by copies), so it is hashed only once."""
+    frame.attrs['boundary_version'] = (boundary_version(frame), len(frame), tuple(frame.total_bounds))
+    return frame
+
+
+def boundary_index(frame, version=None):
+    """SpatialIndex over the polygons of a GeoDataFrame, built once per boundary set.
+
+    Indexes are cached by boundary_version (pass it in if already known), so a
+    boundary file that is read again (e.g. on every rerun of an upload page)
+    reuses its index.
+    """
+    key = version or boundary_version(frame)
+    with _indexes_lock:
+        if key in _indexes:
+            _indexes.move_to_end(key)
+            return _indexes[key]
+    index = SpatialIndex(frame.geometry.values)
+    with _indexes_lock:
+        _indexes[key] = index
+        while len(_indexes) > MAX_CACHED_INDEXES:
+            _indexes.popitem(last=False)
+    return index
+
+
+class BoundaryLayer:
+    """Chiefdom boundaries and everything the maps derive from them, computed once.
+
+    Holds the chiefdom polygons, the outlines dissolved by district and by
+    chiefdom name, the national outline, the boundary lines of each, label
+    points and bounds, overall and per district, and normalized name keys.
+    A layer is shared by every session in the process, so callers must treat
+    it as read-only and copy (e.g. merge) before adding data.
+
+    levels maps simplification tolerances to simplified copies of the layer
+    (see LOD_TOLERANCES and simplify_coverage); level_for picks the one to
+    draw at a given figure size. dissolved, national and levels can be passed
+    in precomputed (as read from a boundary pack); otherwise they are derived
+    from the chiefdoms.
+    """
+
+    def __init__(self, chiefdoms, district_col=DISTRICT_COL, chiefdom_col=CHIEFDOM_COL, dissolved=None,
+                 national=None, tolerance=0.0, levels=None):
+        self.district_col = district_col
+        self.chiefdom_col = chiefdom_col
+        self.chiefdoms = chiefdoms
+        self.tolerance = tolerance
+
+        # Outlines dissolved by each name column, and their boundary lines
+        if dissolved is None:
+            dissolved = {col: chiefdoms[[col, 'geometry']].dissolve(by=col) for col in (district_col, chiefdom_col)}
+        self.dissolved = dissolved
+        self.dissolved_boundaries = {col: outlines.boundary for col, outlines in self.dissolved.items()}
+        self.districts = self.dissolved[district_col]
+        if national is None:
+            national = gpd.GeoSeries([self.districts.union_all()], crs=chiefdoms.crs)
+        self.national = national
+        self.national_boundary = self.national.boundary
+        self.chiefdom_boundaries = chiefdoms.boundary
+
+        # Normalized district and chiefdom names, one row per chiefdom
+        self.name_keys = pd.DataFrame({
+            'district_key': chiefdoms[district_col].map(name_key),
+            'chiefdom_key': chiefdoms[chiefdom_col].map(name_key)
+        }, index=chiefdoms.index)
+
+        # Chiefdom label points, one row per chiefdom with x, y and name
+        centroids = chiefdoms.centroid
+        self.label_points = pd.DataFrame({
+            'x': centroids.x.to_numpy(),
+            'y': centroids.y.to_numpy(),
+            chiefdom_col: chiefdoms[chiefdom_col].to_numpy()
+        }, index=chiefdoms.index)
+
+        # Bounds as (minx, miny, maxx, maxy)
+        self.bounds = tuple(chiefdoms.total_bounds)
+        self.district_extents = {district: tuple(row) for district, row in
+                                 zip(self.districts.index, self.districts.bounds.to_numpy())}
+
+        # Per-district subsets of the chiefdom-level layers
+        rows = chiefdoms.groupby(district_col, sort=False).indices
+        self.district_rows = {district: np.sort(positions) for district, positions in rows.items()}
+        self.district_chiefdom_boundaries = {district: self.chiefdom_boundaries.iloc[positions]
+                                             for district, positions in self.district_rows.items()}
+        self.district_label_points = {district: self.label_points.iloc[positions]
+                                      for district, positions in self.district_rows.items()}
+
+        # Simplified levels of detail, each one derived from a simplified
+        # coverage so every outline at that level lines up with its chiefdoms
+        if levels is None:
+            levels = {} if tolerance else {
+                level_tolerance: BoundaryLayer(simplify_coverage(chiefdoms, level_tolerance), district_col,
+                                               chiefdom_col, tolerance=level_tolerance, levels={})
+                for level_tolerance in LOD_TOLERANCES if level_tolerance
+            }
+        self.levels = {tolerance: self, **levels}
+
+    def level_for(self, figsize, dpi, extent=None):
+        """The level of detail to draw extent (default: the whole layer) on a figsize figure at dpi.
+
+        That is the most simplified level whose simplification stays below
+        one pixel.
+        """
+        return self.levels[pick_tolerance(extent or self.bounds, figsize, dpi, list(self.levels))]
+
+    @cached_property
+    def spatial_index(self):
+        """SpatialIndex over the chiefdom polygons, in chiefdoms row order."""
+        return SpatialIndex(self.chiefdoms.geometry.values)
+
+    @classmethod
+    def from_file(cls, path, **kwargs):
+        """Read a chiefdom shapefile (or any file geopandas reads) into a layer."""
+        return cls(gpd.read_file(path), **kwargs)
+
+    def write_pack(self, path, source_sha256=None):
+        """Save the layer as a boundary pack directory at path.
+
+        The pack holds one GeoParquet file (WKB geometries with bounding-box
+        columns, a spatial index that readers can filter on) per layer:
+        the chiefdoms with their name keys, the dissolved outlines and the
+        national outline, plus a manifest with the bounds and the hash of the
+        source it was built from. Simplified levels are stored as packs of
+        their own under levels/.
+        """
+        parent = os.path.dirname(os.path.abspath(path))
+        staging = tempfile.mkdtemp(dir=parent, prefix='.boundarypack-')
+        try:
+            chiefdoms = self.chiefdoms.join(self.name_keys)
+            chiefdoms.to_parquet(os.path.join(staging, 'chiefdoms.parquet'), write_covering_bbox=True)
+            for col, outlines in self.dissolved.items():
+                outlines.reset_index().to_parquet(os.path.join(staging, f'dissolved_{col}.parquet'),
+                                                  write_covering_bbox=True)
+            gpd.GeoDataFrame(geometry=self.national).to_parquet(os.path.join(staging, 'national.parquet'))
+            levels = {tolerance: level for tolerance, level in self.levels.items() if level is not self}
+            if levels:
+                os.makedirs(os.path.join(staging, 'levels'))
+            for tolerance, level in levels.items():
+                level.write_pack(os.path.join(staging, 'levels', repr(tolerance)))
+            manifest = {
+                'format_version': PACK_FORMAT_VERSION,
+                'source_sha256': source_sha256,
+                'district_col': self.district_col,
+                'chiefdom_col': self.chiefdom_col,
+                'key_columns': list(self.name_keys.columns),
+                'tolerance': self.tolerance,
+                'level_tolerances': sorted(levels),
+                'bounds': list(self.bounds),
+                'created_at': datetime.now(timezone.utc).isoformat(timespec='seconds')
+            }
+            with open(os.path.join(staging, 'manifest.json'), 'w') as f:
+                json.dump(manifest, f, indent=2)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            os.replace(staging, path)
+        except BaseException:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+
+    @classmethod
+    def read_pack(cls, path):
+        """Load a layer from a boundary pack directory written by write_pack."""
+        manifest = read_pack_manifest(path)
+        chiefdoms = gpd.read_parquet(os.path.join(path, 'chiefdoms.parquet'))
+        chiefdoms = chiefdoms.drop(columns=manifest['key_columns'] + ['bbox'], errors='ignore')
+        dissolved = {}
+        for col in (manifest['district_col'], manifest['chiefdom_col']):
+            outlines = gpd.read_parquet(os.path.join(path, f'dissolved_{col}.parquet'))
+            dissolved[col] = outlines.drop(columns='bbox', errors='ignore').set_index(col)
+        national = gpd.read_parquet(os.path.join(path, 'national.parquet')).geometry
+        levels = {tolerance: cls.read_pack(os.path.join(path, 'levels', repr(tolerance)))
+                  for tolerance in manifest['level_tolerances']}
+        return cls(chiefdoms, manifest['district_col'], manifest['chiefdom_col'], dissolved=dissolved,
+                   national=national, tolerance=manifest['tolerance'], levels=levels)
+
+
+def read_pack_manifest(path):
+    """Return the manifest of a boundary pack, or None if there is no (readable) pack at path."""
+    try:
+        with open(os.path.join(path, 'manifest.json')) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def default_pack_path(source):
+    """Where the boundary pack of a source file lives: next to it, e.g. 'Chiefdom 2021.boundarypack'."""
+    return os.path.splitext(source)[0] + PACK_SUFFIX
+
+
+def source_fingerprint(source):
+    """SHA-256 of a boundary file together with its shapefile companions."""
+    stem, extension = os.path.splitext(source)
+    paths = [source] + [stem + companion for companion in SOURCE_EXTENSIONS
+                        if companion != extension.lower() and os.path.exists(stem + companion)]
+    digest = hashlib.sha256()
+    for path in paths:
+        digest.update(os.path.basename(path).encode())
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def pack_is_current(pack_path, source_sha256, district_col=DISTRICT_COL, chiefdom_col=CHIEFDOM_COL):
+    """Whether the pack at pack_path was built by this version, from this source, on these columns."""
+    manifest = read_pack_manifest(pack_path)
+    return (manifest is not None and manifest.get('format_version') == PACK_FORMAT_VERSION
+            and manifest.get('source_sha256') == source_sha256
+            and manifest.get('district_col') == district_col and manifest.get('chiefdom_col') == chiefdom_col)
+
+
+def build_boundary_pack(source, pack_path=None, district_col=DISTRICT_COL, chiefdom_col=CHIEFDOM_COL):
+    """Build the boundary pack of a source file and return the layer."""
+    layer = BoundaryLayer.from_file(source, district_col=district_col, chiefdom_col=chiefdom_col)
+    layer.write_pack(pack_path or default_pack_path(source), source_fingerprint(source))
+    return layer
+
+
+def load_boundary_layer(source, pack_path=None, write_pack=True, district_col=DISTRICT_COL,
+                        chiefdom_col=CHIEFDOM_COL):
+    """Load the BoundaryLayer of a source file, from its boundary pack when that is current.
+
+    A missing or stale pack means reading and dissolving the source; with
+    write_pack, the pack is then (re)built for next time if the directory is
+    writable.
+    """
+    pack_path = pack_path or default_pack_path(source)
+    source_sha256 = source_fingerprint(source)
+    if pack_is_current(pack_path, source_sha256, district_col, chiefdom_col):
+        try:
+            return BoundaryLayer.read_pack(pack_path)
+        except (ImportError, OSError, ValueError, KeyError):
+            # No pyarrow, or a damaged pack: read the source instead
+            pass
+
+    layer = BoundaryLayer.from_file(source, district_col=district_col, chiefdom_col=chiefdom_col)
+    if write_pack:
+        try:
+            layer.write_pack(pack_path, source_sha256)
+        except (ImportError, OSError):
+            pass
+    return layer
+
+
+@lru_cache(maxsize=None)
+def boundary_layer():
+    """The chiefdom BoundaryLayer of this process, loaded on first use and shared by all sessions."""
+    return load_boundary_layer(chiefdom_shapefile_path())
@@ -0,0 +1,57 @@
+"""Build the boundary pack of a chiefdom boundary file.
+
+A boundary pack is a directory of GeoParquet files holding the chiefdom
+polygons, their normalized name keys and the district, chiefdom-name and
+national dissolves, plus simplified levels of detail of all of them for
+drawing at smaller scales. The map apps load it instead of reading and
+dissolving the shapefile at start-up, as long as it matches the shapefile it
+was built from; otherwise they fall back to the shapefile.
+
+Example:
+    python build_boundary_pack.py                       # the app's chiefdom shapefile
+    python build_boundary_pack.py boundaries.gpkg -o boundaries.boundarypack \
+        --district-col district --chiefdom-col chiefdom
+"""
+import argparse
+import os
+import sys
+import time
+
+from asset_cache import chiefdom_shapefile_path
+from boundaries import (CHIEFDOM_COL, DISTRICT_COL, BoundaryLayer, build_boundary_pack, default_pack_path,
+                        pack_is_current, source_fingerprint)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build the boundary pack of a chiefdom boundary file.")
+    parser.add_argument('source', nargs='?', help="Boundary file (default: the app's chiefdom shapefile)")
+    parser.add_argument('-o', '--output', help="Pack directory (default: next to the source, *.boundarypack)")
+    parser.add_argument('--district-col', default=DISTRICT_COL, help=f"District name column (default: {DISTRICT_COL})")
+    parser.add_argument('--chiefdom-col', default=CHIEFDOM_COL, help=f"Chiefdom name column (default: {CHIEFDOM_COL})")
+    parser.add_argument('--force', action='store_true', help="Rebuild even if the pack is up to date")
+    args = parser.parse_args(argv)
+
+    source = args.source or chiefdom_shapefile_path()
+    pack_path = args.output or default_pack_path(source)
+    if not args.force and pack_is_current(pack_path, source_fingerprint(source), args.district_col,
+                                          args.chiefdom_col):
+        print(f"{pack_path} is up to date")
+        return 0
+
+    start_time = time.perf_counter()
+    layer = build_boundary_pack(source, pack_path, args.district_col, args.chiefdom_col)
+    build_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    BoundaryLayer.read_pack(pack_path)
+    load_time = time.perf_counter() - start_time
+
+    size = sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(pack_path) for name in names)
+    print(f"Built {pack_path} from {source}: {len(layer.chiefdoms)} chiefdoms, {len(layer.districts)} districts, "
+          f"{len(layer.levels)} levels of detail, {size / 2 ** 20:.1f} MB")
+    print(f"Build {build_time:.2f}s, load {load_time:.2f}s")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,269 @@
+import io
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import shapely
+from matplotlib.collections import LineCollection, PatchCollection
+from matplotlib.colors import to_rgba_array
+from matplotlib.figure import Figure
+from matplotlib.patches import Patch, PathPatch
+from matplotlib.path import Path
+
+from ingest import read_table, upload_hash
+
+# A choropleth is built in stages, ingest -> join -> classify -> style ->
+# rasterize. Every stage returns (key, result), where key identifies the
+# stage's inputs, including the keys of the stages it builds on; results are
+# memoized by key, so a change only re-runs the stages downstream of it.
+
+
+class StageCache:
+    """Results of one pipeline stage by the key of their inputs, least recently used dropped first."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, compute):
+        """The result cached under key, computing it with compute() first if needed."""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        result = compute()
+        with self._lock:
+            self._entries[key] = result
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return result
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def _polygon_paths(geometries):
+    # One compound path (exterior and holes) per polygon part, and the
+    # position in geometries of the row each part belongs to
+    parts, part_rows = shapely.get_parts(np.asarray(geometries), return_index=True)
+    rings, ring_parts = shapely.get_rings(parts, return_index=True)
+    coords, coord_rings = shapely.get_coordinates(rings, return_index=True)
+    ring_coords = np.split(coords, np.flatnonzero(np.diff(coord_rings)) + 1) if len(coords) else []
+    ring_paths = [[] for _ in range(len(parts))]
+    for part, ring in zip(ring_parts, ring_coords):
+        ring_paths[part].append(Path(ring, closed=True))
+    return [Path.make_compound_path(*paths) for paths in ring_paths], part_rows
+
+
+def _line_segments(geometries):
+    # Vertex arrays of every line part of the geometries
+    parts = shapely.get_parts(np.asarray(geometries))
+    coords, coord_parts = shapely.get_coordinates(parts, return_index=True)
+    return np.split(coords, np.flatnonzero(np.diff(coord_parts)) + 1) if len(coords) else []
+
+
+class ChoroplethCanvas:
+    """A figure of a boundary set drawn once, then recolored and saved for each map.
+
+    The chiefdom polygons become one collection, and outlines (GeoSeries of
+    boundary lines, e.g. dissolved district outlines) and labels (a frame of
+    x, y and text) are drawn over them. render() only assigns the fill
+    colors, line styles, title and legend of a map before saving it, so
+    cycling through indicators never rebuilds the polygon artists. A canvas
+    is shared between sessions; render() holds its lock while drawing.
+    """
+
+    def __init__(self, polygons, outlines=(), labels=None, figsize=(10, 10)):
+        self.fig = Figure(figsize=figsize)
+        self.ax = self.fig.subplots()
+        paths, self.part_rows = _polygon_paths(polygons.geometry.values)
+        self.fill = PatchCollection([PathPatch(path) for path in paths])
+        self.ax.add_collection(self.fill)
+        self.outlines = [LineCollection(_line_segments(lines.values)) for lines in outlines]
+        for collection in self.outlines:
+            self.ax.add_collection(collection)
+        if labels is not None:
+            for x, y, name in labels.itertuples(index=False):
+                self.ax.text(x, y, name, fontsize=10, ha='center', color='black')
+        self.ax.autoscale_view()
+
+        # As GeoDataFrame.plot: geographic coordinates are stretched by the
+        # latitude at the centre, projected ones drawn 1:1
+        if polygons.crs is not None and polygons.crs.is_geographic:
+            minx, miny, maxx, maxy = polygons.total_bounds
+            self.ax.set_aspect(1 / np.cos(np.radians((miny + maxy) / 2)))
+        else:
+            self.ax.set_aspect('equal')
+        self.ax.set_axis_off()
+        self._lock = threading.Lock()
+
+    def render(self, codes, colors, missing_color, edgecolor, linewidth, outline_styles=(), title='', title_size=15,
+               legend=(), legend_title=None, legend_kwargs=None, bold_legend=False, dpi=200):
+        """PNG bytes of the map with polygon i filled with colors[codes[i]], or missing_color where codes[i] is -1.
+
+        outline_styles is a (color, width) pair per outline, legend a list of
+        (color, label) pairs placed by legend_kwargs (passed to ax.legend).
+        """
+        # Vectorized lookup of each polygon part's color by its row's code;
+        # -1 picks the missing color at the end of the palette
+        palette = to_rgba_array(list(colors) + [missing_color])
+        facecolors = palette[np.asarray(codes, dtype=np.intp)[self.part_rows]]
+
+        with self._lock:
+            self.fill.set_facecolor(facecolors)
+            self.fill.set_edgecolor(edgecolor)
+            self.fill.set_linewidth(linewidth)
+            for collection, (color, width) in zip(self.outlines, outline_styles):
+                collection.set_color(color)
+                collection.set_linewidth(width)
+            self.ax.set_title(title, fontsize=title_size, fontweight='bold')
+
+            if self.ax.get_legend() is not None:
+                self.ax.get_legend().remove()
+            if legend:
+                handles = [Patch(color=color, label=label) for color, label in legend]
+                map_legend = self.ax.legend(handles=handles, title=legend_title, **(legend_kwargs or {}))
+                if bold_legend:
+                    map_legend.get_title().set_fontweight('bold')
+                    for text in map_legend.get_texts():
+                        text.set_fontweight('bold')
+
+            png = io.BytesIO()
+            self.fig.savefig(png, format='png', dpi=dpi, bbox_inches='tight', pad_inches=0.1)
+        return png.getvalue()
+
+
+def class_codes(classes, categories, positions, size):
+    """Code (position in categories, -1 if missing) of each of size polygons, from the classes of joined rows.
+
+    positions gives the polygon of each joined row (see merge_chiefdom_data);
+    when several rows share a polygon the last one wins, as it would be
+    drawn on top.
+    """
+    codes = np.full(size, -1, dtype=np.intp)
+    codes[positions] = pd.Categorical(classes, categories=list(categories)).codes
+    return codes
+
+
+def chiefdom_canvas(layer, outline_columns=(), figsize=(10, 10), district=None):
+    """The ChoroplethCanvas of a boundary layer's chiefdoms, built once per layer, extent and figure size.
+
+    outline_columns are drawn as the layer's dissolved boundaries. With a
+    district, the canvas shows only its chiefdoms, outlined and labelled.
+    """
+    key = (id(layer), tuple(outline_columns), figsize, district)
+
+    def build():
+        if district is None:
+            outlines = [layer.dissolved_boundaries[col] for col in outline_columns]
+            return ChoroplethCanvas(layer.chiefdoms, outlines, figsize=figsize)
+        return ChoroplethCanvas(layer.chiefdoms.iloc[layer.district_rows[district]],
+                                [layer.district_chiefdom_boundaries[district]],
+                                layer.district_label_points[district], figsize)
+    return _canvases.get(key, build)
+
+
+def merge_chiefdom_data(chiefdoms, data, left_on, right_on):
+    """The chiefdoms left-joined to data, and the position in chiefdoms of each joined row."""
+    merged = chiefdoms.assign(_chiefdom_position=np.arange(len(chiefdoms))).merge(
+        data, left_on=left_on, right_on=right_on, how='left')
+    return merged.drop(columns='_chiefdom_position'), merged['_chiefdom_position'].to_numpy()
+
+
+_canvases = StageCache(32)
+_joined = StageCache(8)
+_classified = StageCache(32)
+_styled = StageCache(64)
+_rasterized = StageCache(32)
+
+
+def ingest_stage(upload, columns):
+    """The uploaded table, read with only columns (parsed once per upload, see ingest.read_table)."""
+    key = ('ingest', upload_hash(upload), tuple(columns))
+    return key, read_table(upload, columns=columns)
+
+
+def join_stage(ingested, layer, left_on, right_on):
+    """The layer's chiefdoms left-joined to the ingested table, and the chiefdom of each joined row.
+
+    Shared between sessions: treat as read-only.
+    """
+    key = ('join', ingested[0], id(layer), tuple(left_on), tuple(right_on))
+    return key, _joined.get(key, lambda: merge_chiefdom_data(layer.chiefdoms, ingested[1], left_on, right_on))
+
+
+def numeric_bins(values, num_bins):
+    """Edges of num_bins - 1 equal-width bins spanning values, as used by the numeric maps."""
+    low, high = values.min(), values.max()
+    edges = [low, high]
+    for i in range(num_bins - 1):
+        edges.append(low + i * (high - low) / (num_bins - 1))
+        edges.append(low + (i + 1) * (high - low) / (num_bins - 1))
+    return sorted(set(edges))
+
+
+def classify_stage(ingested, joined, column, scheme):
+    """The class of every joined chiefdom and the number of uploaded rows in each class.
+
+    scheme is ('categorical', categories), for the column's values in that
+    (legend) order, or ('numeric', num_bins, labels), for equal-width bins
+    of the column labelled with labels. Returns (classes, counts,
+    missing_count), classes aligned with the joined rows.
+    """
+    key = ('classify', ingested[0], joined[0], column, scheme)
+
+    def compute():
+        data, merged = ingested[1], joined[1][0]
+        if scheme[0] == 'categorical':
+            categories = list(scheme[1])
+            counts = data[column].value_counts().to_dict()
+            classes = pd.Series(pd.Categorical(merged[column], categories=categories, ordered=True),
+                                index=merged.index)
+        else:
+            _, num_bins, labels = scheme
+            bins = numeric_bins(data[column], num_bins)
+            counts = pd.cut(data[column], bins=bins, labels=list(labels), include_lowest=True).value_counts().to_dict()
+            classes = pd.cut(merged[column], bins=bins, labels=list(labels), include_lowest=True)
+        return classes, counts, int(classes.isna().sum())
+    return key, _classified.get(key, compute)
+
+
+def style_stage(classified, categories, color_mapping, missing_color, missing_label):
+    """Colormap colors and legend entries ((color, label) pairs) of the classified map."""
+    key = ('style', classified[0], tuple(categories), tuple(sorted(color_mapping.items(), key=str)), missing_color,
+           missing_label)
+
+    def compute():
+        _, counts, missing_count = classified[1]
+        colors = [color_mapping[category] for category in categories]
+        legend = [(color_mapping[category], f"{category} ({counts.get(category, 0)})") for category in categories]
+        if missing_count > 0:
+            legend.append((missing_color, f"{missing_label} ({missing_count})"))
+        return {'colors': colors, 'legend': legend, 'missing_color': missing_color, 'missing_label': missing_label}
+    return key, _styled.get(key, compute)
+
+
+def rasterize_stage(joined, classified, styled, layer, outline_columns, cosmetics, figsize=(10, 10), dpi=200):
+    """PNG bytes of the map, recolored on the layer's chiefdom_canvas.
+
+    cosmetics is a dict of title, font_size, legend_title, line_color,
+    line_width and outline_styles, a (color, width) pair per outline column.
+    The outlines are the layer's dissolved boundaries.
+    """
+    key = ('rasterize', joined[0], classified[0], styled[0], id(layer), tuple(outline_columns),
+           tuple(sorted(cosmetics.items())), figsize, dpi)
+
+    def compute():
+        positions = joined[1][1]
+        classes = classified[1][0]
+        style = styled[1]
+        codes = class_codes(classes, classes.cat.categories, positions, len(layer.chiefdoms))
+        return chiefdom_canvas(layer, outline_columns, figsize).render(
+            codes, style['colors'], style['missing_color'], cosmetics['line_color'], cosmetics['line_width'],
+            cosmetics['outline_styles'], cosmetics['title'], cosmetics['font_size'], style['legend'],
+            cosmetics['legend_title'],
+            {'fontsize': 10, 'loc': 'lower left', 'bbox_to_anchor': (-0.5, 0), 'frameon': True, 'title_fontsize': 10},
+            bold_legend=True, dpi=dpi)
+    return key, _rasterized.get(key, compute)
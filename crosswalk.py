@@ -0,0 +1,77 @@
+import os
+import sqlite3
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+# Default location of the crosswalk database, next to the app
+DEFAULT_CROSSWALK_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'hf_crosswalk.sqlite')
+
+
+class CrosswalkStore:
+    """Persistent MFL -> DHIS2 crosswalk of accepted name pairs, kept in SQLite.
+
+    Pairs are keyed by the MFL name in the form it was matched in and the
+    scorer that matched it (name_form, e.g. 'raw/jaro_winkler' or
+    'normalized/indel'), so a later run can resolve a known name by
+    lookup instead of scoring it against the whole DHIS2 list again.
+    """
+
+    def __init__(self, path=DEFAULT_CROSSWALK_PATH):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS crosswalk (
+                    mfl_name TEXT NOT NULL,
+                    name_form TEXT NOT NULL,
+                    dhis2_name TEXT NOT NULL,
+                    score REAL NOT NULL,
+                    updated_at TEXT NOT NULL,
+                    PRIMARY KEY (mfl_name, name_form)
+                )
+            """)
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def lookup(self, mfl_names, name_form='raw'):
+        """Return {mfl_name: (dhis2_name, score)} for the names already in the crosswalk."""
+        mfl_names = list(dict.fromkeys(mfl_names))
+        found = {}
+        with self._connect() as conn:
+            # Stay well below SQLite's limit on query parameters
+            for start in range(0, len(mfl_names), 500):
+                batch = mfl_names[start:start + 500]
+                rows = conn.execute(
+                    f"SELECT mfl_name, dhis2_name, score FROM crosswalk "
+                    f"WHERE name_form = ? AND mfl_name IN ({','.join('?' * len(batch))})",
+                    [name_form] + batch
+                )
+                for mfl_name, dhis2_name, score in rows:
+                    found[mfl_name] = (dhis2_name, score)
+        return found
+
+    def save(self, pairs, name_form='raw'):
+        """Insert or update (mfl_name, dhis2_name, score) pairs."""
+        updated_at = datetime.now(timezone.utc).isoformat(timespec='seconds')
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO crosswalk (mfl_name, name_form, dhis2_name, score, updated_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [(mfl_name, name_form, dhis2_name, float(score), updated_at)
+                 for mfl_name, dhis2_name, score in pairs]
+            )
+
+    def __len__(self):
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM crosswalk").fetchone()[0]
+
+    def clear(self):
+        """Forget every saved pair."""
+        with self._connect() as conn:
+            conn.execute("DELETE FROM crosswalk")
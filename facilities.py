@@ -0,0 +1,258 @@
+import hashlib
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+from boundaries import CHIEFDOM_COL, DISTRICT_COL, boundary_index, boundary_version
+
+# Default location of the facility assignment database, next to the app
+DEFAULT_ASSIGNMENT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'hf_assignments.sqlite')
+# Saved assignments kept at most; the oldest are deleted past this
+MAX_ASSIGNMENTS = 500_000
+
+# Located facility lists kept in memory across reruns and sessions
+MAX_LOCATED = 16
+_located = OrderedDict()
+_located_lock = threading.Lock()
+
+# Longitude/latitude box around Sierra Leone, with a margin, outside which
+# facility coordinates are flagged (minx, miny, maxx, maxy)
+COUNTRY_BOUNDS = (-13.5, 6.75, -10.1, 10.2)
+
+# Values of the coordinate_issue column added by facility_points
+MISSING = 'missing'
+OUT_OF_RANGE = 'out of range'
+SWAPPED = 'swapped'
+OUTSIDE_COUNTRY = 'outside country'
+
+
+def facility_points(data, x_col='w_long', y_col='w_lat', bounds=COUNTRY_BOUNDS):
+    """GeoDataFrame (EPSG:4326) of facilities at their coordinates, built and cleaned in one vectorized pass.
+
+    The coordinate columns are converted to numbers, and a coordinate_issue
+    column flags rows whose coordinates are missing (or not numbers), beyond
+    the valid longitude/latitude range, or outside bounds (default: Sierra
+    Leone). Rows that only fall inside bounds with longitude and latitude
+    swapped are swapped back, in the columns too, and flagged as swapped.
+    Missing and out-of-range rows get no geometry.
+    """
+    x = pd.to_numeric(data[x_col], errors='coerce').to_numpy(dtype=float)
+    y = pd.to_numeric(data[y_col], errors='coerce').to_numpy(dtype=float)
+    issues = np.full(len(data), None, dtype=object)
+
+    missing = np.isnan(x) | np.isnan(y)
+    out_of_range = ~missing & ((np.abs(x) > 180) | (np.abs(y) > 90))
+    issues[missing] = MISSING
+    issues[out_of_range] = OUT_OF_RANGE
+    if bounds is not None:
+        minx, miny, maxx, maxy = bounds
+        inside = (x >= minx) & (x <= maxx) & (y >= miny) & (y <= maxy)
+        inside_swapped = (y >= minx) & (y <= maxx) & (x >= miny) & (x <= maxy)
+        swapped = ~inside & inside_swapped
+        x, y = np.where(swapped, y, x), np.where(swapped, x, y)
+        issues[swapped] = SWAPPED
+        issues[~missing & ~out_of_range & ~inside & ~swapped] = OUTSIDE_COUNTRY
+
+    frame = data.copy()
+    frame[x_col] = x
+    frame[y_col] = y
+    frame['coordinate_issue'] = issues
+    geometry = gpd.points_from_xy(x, y)
+    geometry[missing | out_of_range] = None
+    return gpd.GeoDataFrame(frame, geometry=geometry, crs='EPSG:4326')
+
+
+def usable_facilities(points):
+    """Rows of facility_points whose coordinates are fine as given or once swapped back."""
+    return points[points['coordinate_issue'].isna() | (points['coordinate_issue'] == SWAPPED)]
+
+
+def coordinate_issue_summary(points):
+    """Counts of the flagged coordinates of facility_points, e.g. '3 missing, 1 swapped', or '' if none."""
+    counts = points['coordinate_issue'].value_counts()
+    return ', '.join(f'{count} {issue}' for issue, count in counts.items())
+
+
+class AssignmentStore:
+    """Persistent facility -> chiefdom assignments, kept in SQLite.
+
+    Assignments are keyed by the boundary set they were computed against (see
+    boundaries.boundary_version) and by the facility identifier plus its
+    coordinates, so a re-uploaded workbook only has its new or moved
+    facilities located again. Past max_rows, the oldest saved assignments
+    are deleted.
+    """
+
+    def __init__(self, path=DEFAULT_ASSIGNMENT_PATH, max_rows=MAX_ASSIGNMENTS):
+        self.path = path
+        self.max_rows = max_rows
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS assignments (
+                    boundary_version TEXT NOT NULL,
+                    facility_id TEXT NOT NULL,
+                    x REAL NOT NULL,
+                    y REAL NOT NULL,
+                    position INTEGER NOT NULL,
+                    updated_at TEXT NOT NULL,
+                    PRIMARY KEY (boundary_version, facility_id, x, y)
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS assignments_updated_at ON assignments (updated_at)")
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def lookup(self, boundary_version, keys):
+        """Return {(facility_id, x, y): position} for the keys already assigned.
+
+        Only the rows of the given (facility_id, x, y) keys are read, joined
+        on the table's primary key, however many other facilities are saved.
+        """
+        keys = list(dict.fromkeys((str(facility_id), float(x), float(y)) for facility_id, x, y in keys))
+        with self._connect() as conn:
+            conn.execute("CREATE TEMP TABLE wanted (facility_id TEXT, x REAL, y REAL)")
+            conn.executemany("INSERT INTO wanted (facility_id, x, y) VALUES (?, ?, ?)", keys)
+            rows = conn.execute(
+                "SELECT a.facility_id, a.x, a.y, a.position FROM wanted w JOIN assignments a "
+                "ON a.boundary_version = ? AND a.facility_id = w.facility_id AND a.x = w.x AND a.y = w.y",
+                (boundary_version,)
+            ).fetchall()
+        return {(facility_id, x, y): position for facility_id, x, y, position in rows}
+
+    def save(self, boundary_version, assignments):
+        """Insert or update (facility_id, x, y, position) assignments."""
+        updated_at = datetime.now(timezone.utc).isoformat(timespec='seconds')
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO assignments (boundary_version, facility_id, x, y, position, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(boundary_version, facility_id, float(x), float(y), int(position), updated_at)
+                 for facility_id, x, y, position in assignments]
+            )
+            excess = conn.execute("SELECT COUNT(*) FROM assignments").fetchone()[0] - self.max_rows
+            if excess > 0:
+                conn.execute("DELETE FROM assignments WHERE rowid IN "
+                             "(SELECT rowid FROM assignments ORDER BY updated_at LIMIT ?)", (excess,))
+
+    def __len__(self):
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM assignments").fetchone()[0]
+
+    def clear(self):
+        """Forget every saved assignment."""
+        with self._connect() as conn:
+            conn.execute("DELETE FROM assignments")
+
+
+def assign_chiefdoms(facilities, chiefdoms, id_col=None, store=None):
+    """Position in chiefdoms of the chiefdom each facility lies within, or -1 (see SpatialIndex.locate).
+
+    The positions of the last few facility lists (by identifiers and
+    coordinates) are kept in memory per boundary set, so reruns with the
+    same upload don't locate anything. With a store, facilities already
+    assigned at the same coordinates (and, with id_col, the same
+    identifier) against the same chiefdoms are looked up instead of
+    located; only the rest go through the spatial index, and are saved for
+    next time. The chiefdom only depends on the coordinates, so without
+    id_col they alone are the key.
+    """
+    points = np.asarray(facilities.geometry.values)
+    version = boundary_version(chiefdoms)
+    x, y = shapely.get_x(points), shapely.get_y(points)
+    facility_ids = facilities[id_col].astype(str).tolist() if id_col else [''] * len(facilities)
+
+    digest = hashlib.sha256(x.tobytes() + y.tobytes())
+    digest.update('\0'.join(facility_ids).encode())
+    key = (version, digest.hexdigest())
+    with _located_lock:
+        if key in _located:
+            _located.move_to_end(key)
+            return _located[key].copy()
+
+    positions = _assign_chiefdoms(points, chiefdoms, version, x, y, facility_ids, store)
+    with _located_lock:
+        _located[key] = positions
+        while len(_located) > MAX_LOCATED:
+            _located.popitem(last=False)
+    return positions.copy()
+
+
+def _assign_chiefdoms(points, chiefdoms, version, x, y, facility_ids, store):
+    # assign_chiefdoms of facilities not in memory, through the store if any
+    if store is None:
+        return boundary_index(chiefdoms, version).locate(points)
+    finite = np.isfinite(x) & np.isfinite(y)
+    known = store.lookup(version, [(facility_ids[row], x[row], y[row]) for row in np.flatnonzero(finite)])
+
+    # Facilities without finite coordinates lie in no chiefdom
+    positions = np.full(len(points), -1, dtype=np.intp)
+    pending = []
+    for row, key in enumerate(zip(facility_ids, x.tolist(), y.tolist())):
+        if key in known:
+            positions[row] = known[key]
+        elif finite[row]:
+            pending.append(row)
+
+    if pending:
+        positions[pending] = boundary_index(chiefdoms, version).locate(points[pending])
+        store.save(version, [(facility_ids[row], x[row], y[row], positions[row]) for row in pending])
+    return positions
+
+
+def join_chiefdoms(facilities, chiefdoms, id_col=None, store=None):
+    """Facilities within a chiefdom, with that chiefdom's attributes.
+
+    The result matches gpd.sjoin(facilities, chiefdoms, how="inner",
+    predicate="within"), including index_right and the _left/_right suffixes
+    of clashing columns, but every facility is located against all the
+    chiefdoms in a single pass and appears at most once. id_col and store
+    are passed on to assign_chiefdoms.
+    """
+    return _join_located(facilities, chiefdoms, assign_chiefdoms(facilities, chiefdoms, id_col, store))
+
+
+def _join_located(facilities, chiefdoms, located):
+    # join_chiefdoms of facilities already located (positions in chiefdoms, -1 for none)
+    inside = located >= 0
+    joined = facilities[inside].copy()
+    attributes = chiefdoms.drop(columns=chiefdoms.geometry.name).iloc[located[inside]]
+
+    clashing = [col for col in attributes.columns if col in joined.columns or col == 'index_right']
+    joined = joined.rename(columns={col: f'{col}_left' for col in clashing})
+    attributes = attributes.rename(columns={col: f'{col}_right' for col in clashing})
+    joined['index_right'] = attributes.index.to_numpy()
+    for col in attributes.columns:
+        joined[col] = attributes[col].to_numpy()
+    return joined
+
+
+def district_facilities_by_chiefdom(facilities, chiefdoms, district, id_col=None, store=None,
+                                    district_col=DISTRICT_COL, chiefdom_col=CHIEFDOM_COL):
+    """The facilities of a district, joined as by join_chiefdoms, and {chiefdom name: its facilities}.
+
+    Districts and chiefdoms are told apart by the names in the chiefdoms'
+    own rows, so name columns the facility data happens to share with the
+    chiefdoms (suffixed _left/_right in the join) don't get in the way.
+    """
+    located = assign_chiefdoms(facilities, chiefdoms, id_col, store)
+    joined = _join_located(facilities, chiefdoms, located)
+    names = chiefdoms.iloc[located[located >= 0]]
+    in_district = (names[district_col] == district).to_numpy()
+    district_facilities = joined[in_district]
+    by_chiefdom = dict(tuple(district_facilities.groupby(names[chiefdom_col].to_numpy()[in_district])))
+    return district_facilities, by_chiefdom
@@ -0,0 +1,219 @@
+import hashlib
+import importlib.util
+import io
+import os
+import threading
+import zipfile
+from collections import OrderedDict
+
+import geopandas as gpd
+import pandas as pd
+import shapely
+
+from boundaries import tag_boundary_version
+
+# Parsed uploads kept in memory across reruns and sessions, up to this many bytes
+MAX_CACHE_BYTES = 512 * 2 ** 20
+
+# Faster Excel engine (pip install python-calamine), used when installed;
+# otherwise pandas picks its default (openpyxl for .xlsx, xlrd for .xls)
+EXCEL_ENGINE = 'calamine' if importlib.util.find_spec('python_calamine') else None
+
+# File types accepted as a boundary upload, and the single-file formats among them
+BOUNDARY_FILE_TYPES = ['zip', 'gpkg', 'geojson', 'json', 'shp', 'shx', 'dbf', 'prj', 'cpg']
+BOUNDARY_DATASET_EXTENSIONS = ('.gpkg', '.geojson', '.json')
+
+
+def frame_size(frame):
+    """Estimated memory use in bytes of a DataFrame, counting the coordinates of any geometry columns."""
+    size = int(frame.memory_usage(index=True, deep=True).sum())
+    for col in frame.columns:
+        if isinstance(frame[col].dtype, gpd.array.GeometryDtype):
+            size += int(shapely.get_num_coordinates(frame[col].values).sum()) * 16
+    return size
+
+
+def upload_hash(*uploads):
+    """sha256 of the content of one or more uploaded files (or any objects with getvalue())."""
+    digest = hashlib.sha256()
+    for upload in uploads:
+        data = upload.getvalue()
+        digest.update(len(data).to_bytes(8, 'little'))
+        digest.update(data)
+    return digest.hexdigest()
+
+
+def arrow_strings(frame):
+    """frame with its text columns stored as Arrow-backed strings, which take far less memory than objects.
+
+    Only object columns holding nothing but strings (and missing values)
+    are converted; mixed columns are left alone.
+    """
+    for col in frame.columns:
+        if frame[col].dtype == object and pd.api.types.infer_dtype(frame[col], skipna=True) == 'string':
+            frame[col] = frame[col].astype('string[pyarrow]')
+    return frame
+
+
+class UploadCache:
+    """In-memory LRU cache of parsed uploads, keyed by the hash of their content and how they were read.
+
+    Entries are evicted least recently used first once their estimated size
+    passes max_bytes; a frame larger than that on its own is not cached. A
+    cache is shared by every session in the process, so callers get a copy of
+    the cached frame and can modify it freely.
+    """
+
+    def __init__(self, max_bytes=MAX_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, parse):
+        """The frame cached under key, parsing it with parse() first if needed."""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key][0].copy()
+
+        frame = parse()
+        size = frame_size(frame)
+        with self._lock:
+            self.misses += 1
+            if size <= self.max_bytes and key not in self._entries:
+                self._entries[key] = (frame, size)
+                self.size += size
+                while self.size > self.max_bytes:
+                    _, (_, evicted_size) = self._entries.popitem(last=False)
+                    self.size -= evicted_size
+        return frame.copy()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        """Forget every cached frame."""
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+_upload_cache = UploadCache()
+
+
+def _is_csv(upload):
+    return upload.name.lower().endswith('.csv')
+
+
+def upload_columns(upload, cache=None):
+    """Column names of an uploaded Excel or CSV file, from its header row alone."""
+    cache = _upload_cache if cache is None else cache
+    if _is_csv(upload):
+        key = ('csv columns', upload_hash(upload))
+        header = cache.get(key, lambda: pd.read_csv(io.BytesIO(upload.getvalue()), nrows=0))
+    else:
+        # openpyxl streams the first row; the faster engines load the whole sheet
+        key = ('excel columns', upload_hash(upload))
+        engine = 'openpyxl' if upload.name.lower().endswith('.xlsx') else EXCEL_ENGINE
+        header = cache.get(key, lambda: pd.read_excel(io.BytesIO(upload.getvalue()), nrows=0, engine=engine))
+    return list(header.columns)
+
+
+def _read_options(upload, columns, cache, kwargs):
+    # Read only the wanted columns that exist, in file order, so the same set
+    # of columns is cached once whatever order it was asked for in
+    if columns is not None:
+        kwargs['usecols'] = [col for col in upload_columns(upload, cache) if col in set(columns)]
+    return repr(sorted(kwargs.items()))
+
+
+def read_excel(upload, columns=None, strings='arrow', cache=None, **kwargs):
+    """pd.read_excel of an uploaded file, parsed once per content and set of read options.
+
+    columns limits the read to those columns (missing ones are skipped).
+    The faster EXCEL_ENGINE is used when installed, and text columns are
+    stored as Arrow strings unless strings is 'object'.
+    """
+    cache = _upload_cache if cache is None else cache
+    kwargs.setdefault('engine', EXCEL_ENGINE)
+    key = ('excel', upload_hash(upload), strings, _read_options(upload, columns, cache, kwargs))
+
+    def parse():
+        frame = pd.read_excel(io.BytesIO(upload.getvalue()), **kwargs)
+        return arrow_strings(frame) if strings == 'arrow' else frame
+    return cache.get(key, parse)
+
+
+def read_csv(upload, columns=None, strings='arrow', cache=None, **kwargs):
+    """pd.read_csv of an uploaded file, parsed once per content and set of read options.
+
+    As read_excel, with pyarrow's multithreaded CSV parser as the engine.
+    """
+    cache = _upload_cache if cache is None else cache
+    kwargs.setdefault('engine', 'pyarrow')
+    key = ('csv', upload_hash(upload), strings, _read_options(upload, columns, cache, kwargs))
+
+    def parse():
+        frame = pd.read_csv(io.BytesIO(upload.getvalue()), **kwargs)
+        return arrow_strings(frame) if strings == 'arrow' else frame
+    return cache.get(key, parse)
+
+
+def read_table(upload, columns=None, strings='arrow', cache=None, **kwargs):
+    """read_excel or read_csv of an uploaded file, by its name."""
+    reader = read_csv if _is_csv(upload) else read_excel
+    return reader(upload, columns, strings, cache, **kwargs)
+
+
+def _dataset_bytes(files):
+    # A zip holding one boundary dataset at its root, from {file name: bytes}
+    # of a shapefile's parts or of a GeoPackage/GeoJSON file
+    shapefiles = sorted(name for name in files if name.lower().endswith('.shp'))
+    if not shapefiles:
+        datasets = sorted(name for name in files if name.lower().endswith(BOUNDARY_DATASET_EXTENSIONS))
+        if not datasets:
+            raise ValueError("No shapefile, GeoPackage or GeoJSON file found in the upload")
+        return files[datasets[0]]
+
+    stem = os.path.splitext(shapefiles[0])[0]
+    parts = {name: data for name, data in files.items() if os.path.splitext(name)[0] == stem}
+    extensions = {os.path.splitext(name)[1].lower() for name in parts}
+    missing = [extension for extension in ('.shx', '.dbf') if extension not in extensions]
+    if missing:
+        raise ValueError(f"The shapefile {shapefiles[0]} is missing its {' and '.join(missing)} file")
+    archive_bytes = io.BytesIO()
+    with zipfile.ZipFile(archive_bytes, 'w', zipfile.ZIP_STORED) as archive:
+        for name, data in parts.items():
+            archive.writestr(name, data)
+    return archive_bytes.getvalue()
+
+
+def _read_boundaries(uploads):
+    files = {upload.name: upload.getvalue() for upload in uploads}
+    if len(files) == 1 and next(iter(files)).lower().endswith('.zip'):
+        with zipfile.ZipFile(io.BytesIO(next(iter(files.values())))) as archive:
+            # Flatten folders, skipping macOS metadata
+            files = {os.path.basename(name): archive.read(name) for name in archive.namelist()
+                     if not name.endswith('/') and not name.startswith('__MACOSX/')
+                     and not os.path.basename(name).startswith('.')}
+    # GDAL reads the bytes through its in-memory (/vsimem/) filesystem
+    return gpd.read_file(io.BytesIO(_dataset_bytes(files)))
+
+
+def read_boundaries(uploads, cache=None):
+    """GeoDataFrame of an uploaded boundary set, read from memory and parsed once per content.
+
+    uploads is one uploaded file or a list of them: a zipped shapefile (in
+    any folder of the zip), a GeoPackage or GeoJSON file, or the separate
+    .shp, .shx and .dbf (and optional .prj, .cpg) files of a shapefile.
+    Nothing is written to disk. The frame is tagged with its boundary_version
+    (see boundaries.tag_boundary_version) as it is parsed.
+    """
+    cache = _upload_cache if cache is None else cache
+    uploads = sorted(uploads if isinstance(uploads, (list, tuple)) else [uploads], key=lambda upload: upload.name)
+    key = ('boundaries', tuple(upload.name for upload in uploads), upload_hash(*uploads))
+    return cache.get(key, lambda: tag_boundary_version(_read_boundaries(uploads)))
@@ -0,0 +1,200 @@
+"""Match health facility names between an MFL list and a DHIS2 list from the command line.
+
+Runs the same matching engine as the Name Matching page, without Streamlit,
+for scheduled reconciliation runs. The MFL list is read and matched in chunks
+and the results are streamed to a CSV or Parquet file as they are produced.
+
+Example:
+    python match_names.py mfl.xlsx dhis2.csv --mfl-col hf --dhis2-col orgunit \
+        --threshold 80 --normalize --block district=orgunitlevel2 -o matches.parquet
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from crosswalk import CrosswalkStore
+from name_matching import MatchingEngine, add_suggested_names, calculate_match, leftover_results
+
+
+def read_table(path):
+    """Read a whole CSV, Excel or Parquet file."""
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.csv':
+        return pd.read_csv(path)
+    if extension in ('.xlsx', '.xls'):
+        return pd.read_excel(path)
+    if extension == '.parquet':
+        return pd.read_parquet(path)
+    raise ValueError(f"Unsupported input file type: {path}")
+
+
+def iter_table_chunks(path, chunk_rows):
+    """Yield a CSV, Excel or Parquet file as dataframes of at most chunk_rows rows."""
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.csv':
+        yield from pd.read_csv(path, chunksize=chunk_rows)
+    elif extension == '.parquet':
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_rows):
+            yield batch.to_pandas()
+    else:
+        # Excel workbooks can't be read partially
+        table = read_table(path)
+        for start in range(0, len(table), chunk_rows):
+            yield table.iloc[start:start + chunk_rows]
+
+
+class ResultWriter:
+    """Append results chunk by chunk to a CSV or Parquet file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.is_parquet = os.path.splitext(path)[1].lower() == '.parquet'
+        self.parquet_writer = None
+        self.rows = 0
+
+    def write(self, results):
+        if self.is_parquet:
+            self.write_parquet(results)
+        else:
+            results.to_csv(self.path, mode='a' if self.rows else 'w', header=not self.rows, index=False)
+        self.rows += len(results)
+
+    def write_parquet(self, results):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        # Every chunk must fit the schema of the first one: numbers are stored
+        # as float64 (leftover rows leave gaps in integer columns) and
+        # everything else as text
+        columns = {}
+        for col in results.columns:
+            values = results[col]
+            numeric = self.parquet_writer.schema.field(col).type == pa.float64() if self.parquet_writer else (
+                pd.api.types.is_numeric_dtype(values) or values.isna().all())
+            if numeric:
+                try:
+                    columns[col] = pa.array(pd.to_numeric(values).astype('float64'), from_pandas=True)
+                except (TypeError, ValueError):
+                    raise ValueError(f"Column '{col}' changes type between chunks; "
+                                     f"write CSV or use larger --chunk-rows") from None
+            else:
+                columns[col] = pa.array(values.astype(object).where(values.notna(), None).map(
+                    lambda v: v if v is None else str(v)), type=pa.string())
+        table = pa.table(columns)
+        if self.parquet_writer is None:
+            self.parquet_writer = pq.ParquetWriter(self.path, table.schema)
+        self.parquet_writer.write_table(table.select(self.parquet_writer.schema.names))
+
+    def close(self):
+        if self.parquet_writer is not None:
+            self.parquet_writer.close()
+
+
+def parse_block(value):
+    """Parse a MFL_COLUMN=DHIS2_COLUMN blocking pair."""
+    if '=' not in value:
+        raise argparse.ArgumentTypeError("blocking columns must be given as MFL_COLUMN=DHIS2_COLUMN")
+    mfl_col, dhis2_col = value.split('=', 1)
+    return mfl_col, dhis2_col
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Match health facility names between an MFL and a DHIS2 list.")
+    parser.add_argument('mfl', help="Master facility list (CSV, Excel or Parquet)")
+    parser.add_argument('dhis2', help="DHIS2 facility list (CSV, Excel or Parquet)")
+    parser.add_argument('--mfl-col', required=True, help="HF name column in the MFL list")
+    parser.add_argument('--dhis2-col', required=True, help="HF name column in the DHIS2 list")
+    parser.add_argument('-o', '--output', required=True, help="Results file (.csv or .parquet)")
+    parser.add_argument('--threshold', type=float, default=70, help="Match threshold, 0-100 (default: 70)")
+    parser.add_argument('--normalize', action='store_true', help="Normalize names before matching")
+    parser.add_argument('--strip-types', action='store_true',
+                        help="Ignore facility types (CHC, MCHP, ...) when normalizing")
+    parser.add_argument('--block', type=parse_block, action='append', default=[], metavar='MFL_COL=DHIS2_COL',
+                        help="Only match facilities with equal values in these columns (repeatable)")
+    parser.add_argument('--no-national-fallback', action='store_true',
+                        help="With --block, don't search the whole list for names unmatched in their block")
+    parser.add_argument('--one-to-one', action='store_true',
+                        help="Match each DHIS2 facility at most once (reads the whole MFL list at once)")
+    parser.add_argument('--top-k', type=int, default=0, help="Candidates per name from the n-gram index (0 = all)")
+    parser.add_argument('--processes', type=int, default=0, help="Worker processes for scoring (0 = none)")
+    parser.add_argument('--max-memory-mb', type=int, default=512, help="Memory limit for score matrices")
+    parser.add_argument('--chunk-rows', type=int, default=5000, help="MFL rows matched per chunk")
+    parser.add_argument('--crosswalk', help="SQLite crosswalk of accepted matches to reuse and update")
+    args = parser.parse_args(argv)
+
+    if os.path.splitext(args.output)[1].lower() not in ('.csv', '.parquet'):
+        parser.error("the output file must end in .csv or .parquet")
+
+    start_time = time.perf_counter()
+    engine = MatchingEngine(top_k=args.top_k or None, processes=args.processes or None,
+                            max_memory_mb=args.max_memory_mb)
+    crosswalk = CrosswalkStore(args.crosswalk) if args.crosswalk else None
+    mfl_block_cols = [mfl_col for mfl_col, dhis2_col in args.block]
+
+    dhis2 = read_table(args.dhis2)
+    dhis2[args.dhis2_col] = dhis2[args.dhis2_col].astype(str)
+
+    if args.one_to_one:
+        chunks = [read_table(args.mfl)]
+    else:
+        chunks = iter_table_chunks(args.mfl, args.chunk_rows)
+
+    writer = ResultWriter(args.output)
+    matched_dhis2 = None if args.one_to_one else set()
+    seen = set()
+    mfl_template = None
+    n_mfl = n_matched = n_pairs = 0
+    try:
+        for chunk in chunks:
+            # Drop names already seen, in this chunk or an earlier one
+            chunk = chunk.copy()
+            chunk[args.mfl_col] = chunk[args.mfl_col].astype(str)
+            keys = list(chunk[[args.mfl_col] + mfl_block_cols].astype(str).itertuples(index=False, name=None))
+            keep = np.array([key not in seen for key in keys]) & ~pd.Series(keys).duplicated().to_numpy()
+            seen.update(keys)
+            chunk = chunk[keep]
+            if mfl_template is None:
+                mfl_template = chunk.iloc[:0]
+            if chunk.empty:
+                continue
+
+            results = calculate_match(
+                chunk, dhis2, args.mfl_col, args.dhis2_col, args.threshold,
+                engine=engine,
+                block_on=args.block,
+                national_fallback=not args.no_national_fallback,
+                normalize=args.normalize,
+                strip_types=args.strip_types,
+                crosswalk=crosswalk,
+                one_to_one=args.one_to_one,
+                matched_dhis2=matched_dhis2
+            )
+            writer.write(add_suggested_names(results, args.threshold))
+            n_mfl += len(chunk)
+            n_pairs += results.attrs['pairs_scored']
+            n_matched += int((results['HF_Name_in_MFL'].notna() & (results['Match_Status'] == 'Match')).sum())
+
+        if matched_dhis2 is not None and mfl_template is not None:
+            leftovers = leftover_results(mfl_template, dhis2, args.mfl_col, args.dhis2_col, matched_dhis2,
+                                         args.normalize, args.strip_types)
+            if not leftovers.empty:
+                writer.write(add_suggested_names(leftovers, args.threshold))
+    finally:
+        writer.close()
+
+    elapsed = time.perf_counter() - start_time
+    print(f"Matched {n_mfl} MFL names against {len(dhis2)} DHIS2 facilities: "
+          f"{n_matched} matches, {writer.rows} result rows written to {args.output}")
+    # Only pairs that went through the scorer count: exact, crosswalk and
+    # blocked-out names, and candidates top_k skipped, are not scored
+    print(f"Elapsed {elapsed:.2f}s, {n_pairs:,} name pairs scored, {n_pairs / max(elapsed, 1e-9):,.0f} pairs/s")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
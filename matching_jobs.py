@@ -0,0 +1,129 @@
+import copy
+import threading
+import time
+import uuid
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+
+from name_matching import calculate_match
+
+# Matching jobs run in this many background threads at once; further jobs queue
+MAX_RUNNING_JOBS = 2
+# Finished jobs kept for pick-up before the oldest are dropped
+MAX_FINISHED_JOBS = 8
+
+# Jobs live for the whole server process, so they outlive reruns and page reloads
+_executor = ThreadPoolExecutor(MAX_RUNNING_JOBS, thread_name_prefix='matching-job')
+_jobs = {}
+_jobs_lock = threading.Lock()
+
+
+class MatchCancelled(Exception):
+    """Raised inside a matching job to stop it after it was cancelled."""
+
+
+class MatchJob:
+    """A calculate_match run in a background thread.
+
+    progress is the share of the work done so far (0-1), updated by the
+    engine every hundred or so names (see name_matching.PROGRESS_ROWS). meta
+    holds whatever the caller needs to pick the job up again, e.g. the cache
+    key of its inputs and settings.
+    """
+
+    def __init__(self, meta=None):
+        self.id = uuid.uuid4().hex
+        self.meta = meta or {}
+        self.progress = 0.0
+        self.created_at = time.time()
+        self.future = None
+        self._cancel = threading.Event()
+
+    def report(self, share):
+        """Engine progress callback; stops the job once it is cancelled."""
+        if self._cancel.is_set():
+            raise MatchCancelled()
+        self.progress = share
+
+    def cancel(self):
+        """Ask the job to stop at its next progress report (or not to start at all)."""
+        self._cancel.set()
+        self.future.cancel()
+
+    @property
+    def status(self):
+        """'running', 'done', 'cancelled' or 'failed' ('running' includes queued jobs)."""
+        if not self.future.done():
+            return 'running'
+        if self.future.cancelled() or isinstance(self.future.exception(), MatchCancelled):
+            return 'cancelled'
+        if self.future.exception() is not None:
+            return 'failed'
+        return 'done'
+
+    @property
+    def error(self):
+        """The exception a failed job raised, else None."""
+        return self.future.exception() if self.status == 'failed' else None
+
+    def result(self):
+        """{'results': ..., 'recall': ...} of a finished job."""
+        try:
+            return self.future.result()
+        except CancelledError:
+            raise MatchCancelled() from None
+
+
+def run_match(job, df1, df2, name_col1, name_col2, threshold, engine, recall_sample, kwargs):
+    """Body of a matching job: calculate_match, plus the candidate recall when top_k is used.
+
+    Progress covers both passes, each weighted by the number of names it scores.
+    """
+    engine = copy.copy(engine)
+    engine.progress = job.report
+    recall_size = min(len(df1), recall_sample) if engine.top_k else 0
+    total = max(len(df1) + recall_size, 1)
+    results = calculate_match(df1, df2, name_col1, name_col2, threshold,
+                              engine=engine.part_engine(0, len(df1), total), **kwargs)
+    recall = None
+    if engine.top_k:
+        recall = engine.part_engine(len(df1), recall_size, total).candidate_recall(
+            df1[name_col1], df2[name_col2].tolist(), sample_size=recall_sample)
+    job.progress = 1.0
+    return {'results': results, 'recall': recall}
+
+
+def submit_match_job(df1, df2, name_col1, name_col2, threshold, engine, meta=None, recall_sample=1000,
+                     **kwargs):
+    """Start calculate_match in the background and return its MatchJob.
+
+    kwargs are passed on to calculate_match. The frames should not be
+    modified while the job runs.
+    """
+    job = MatchJob(meta)
+    with _jobs_lock:
+        forget_finished_jobs()
+        job.future = _executor.submit(run_match, job, df1, df2, name_col1, name_col2, threshold, engine,
+                                      recall_sample, kwargs)
+        _jobs[job.id] = job
+    return job
+
+
+def get_job(job_id):
+    """Return the MatchJob with this id, or None if it is unknown or was dropped."""
+    with _jobs_lock:
+        return _jobs.get(job_id)
+
+
+def forget_job(job_id):
+    """Drop a job (cancelling it if it still runs)."""
+    with _jobs_lock:
+        job = _jobs.pop(job_id, None)
+    if job is not None and job.status == 'running':
+        job.cancel()
+
+
+def forget_finished_jobs(keep=MAX_FINISHED_JOBS):
+    """Drop all but the keep most recent finished jobs. Call with _jobs_lock held."""
+    finished = sorted((job for job in _jobs.values() if job.future.done()), key=lambda job: job.created_at)
+    for job in finished[:max(len(finished) - keep, 0)]:
+        del _jobs[job.id]
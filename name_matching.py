@@ -0,0 +1,811 @@
+import copy
+import hashlib
+import re
+import unicodedata
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+from rapidfuzz import process
+from rapidfuzz.distance import JaroWinkler, Levenshtein, Indel
+from scipy import sparse
+from scipy.sparse.csgraph import min_weight_full_bipartite_matching
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+# Scorers available to the matching engine. Each one takes two strings and
+# returns a similarity between 0 and 1, like rapidfuzz's normalized scorers.
+SCORERS = {
+    'jaro_winkler': JaroWinkler.normalized_similarity,
+    'levenshtein': Levenshtein.normalized_similarity,
+    'indel': Indel.normalized_similarity,
+}
+
+# Multi-word facility types, rewritten to their usual abbreviation
+FACILITY_TYPE_PHRASES = [
+    (re.compile(r'\bmaternal (?:and )?child health post\b'), 'mchp'),
+    (re.compile(r'\bcommunity health cent(?:re|er)\b'), 'chc'),
+    (re.compile(r'\bcommunity health post\b'), 'chp'),
+]
+
+# Spelling variants of single words, mapped to one canonical token
+TOKEN_VARIANTS = {
+    'hosp': 'hospital',
+    'hospt': 'hospital',
+    'hsp': 'hospital',
+    'govt': 'government',
+    'gov': 'government',
+    'gvt': 'government',
+    'clin': 'clinic',
+    'centre': 'center',
+    'ctr': 'center',
+    'st': 'saint',
+}
+
+# Canonical tokens naming the type of a facility rather than the facility
+FACILITY_TYPE_TOKENS = {'hospital', 'chc', 'chp', 'mchp', 'clinic'}
+
+# Most queries scored between two calls of a progress callback, however many
+# the memory budget would allow at once, so progress and cancelling keep up
+PROGRESS_ROWS = 128
+
+# Canonical forms of facility names kept in memory; a server sees every
+# uploaded list, so the cache is bounded
+NORMALIZE_CACHE_SIZE = 100_000
+
+
+@lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
+def normalize_name(name, strip_types=False):
+    """Return the canonical form of a facility name.
+
+    Accents, case and punctuation are folded away and spelling variants of
+    facility-type words are unified, so "Kenema Govt. Hospital" and
+    "KENEMA GOVERNMENT HOSP" both become "kenema government hospital". With
+    strip_types, facility-type tokens (CHC, MCHP, CHP, hospital, clinic) are
+    dropped as well, unless nothing else is left.
+    """
+    folded = unicodedata.normalize('NFKD', str(name)).encode('ascii', 'ignore').decode().casefold()
+    folded = re.sub(r'[^0-9a-z]+', ' ', folded)
+    for pattern, replacement in FACILITY_TYPE_PHRASES:
+        folded = pattern.sub(replacement, folded)
+    tokens = [TOKEN_VARIANTS.get(token, token) for token in folded.split()]
+    if strip_types:
+        tokens = [token for token in tokens if token not in FACILITY_TYPE_TOKENS] or tokens
+    return ' '.join(tokens)
+
+
+def normalize_names(names, strip_types=False):
+    """Normalize a column of names, running the pipeline once per unique name."""
+    names = pd.Series(names).astype(str)
+    canonical = {name: normalize_name(name, strip_types) for name in names.unique()}
+    return names.map(canonical).tolist()
+
+
+def match_forms(names, normalize=False, strip_types=False):
+    """Return a column of names as text in the form they are matched in."""
+    if normalize:
+        return normalize_names(names, strip_types)
+    return pd.Series(names).astype(str).tolist()
+
+
+class NgramIndex:
+    """Character n-gram TF-IDF index over a list of names for candidate retrieval.
+
+    top_k returns, for every query, the positions of the k indexed names with
+    the highest cosine similarity between their n-gram vectors. Only those
+    candidates need to go through the (much slower) string scorer.
+
+    N-grams found in more than max_df of the names (e.g. the ones from "CHC"
+    or "MCHP") say little about a match but make the similarity matrix dense,
+    so they are left out of the index.
+    """
+
+    def __init__(self, names, ngram_range=(2, 3), max_df=0.1):
+        names = [str(name) for name in names]
+        self.vectorizer = TfidfVectorizer(analyzer='char_wb', ngram_range=ngram_range,
+                                          lowercase=True, max_df=max_df, dtype=np.float32)
+        try:
+            matrix = self.vectorizer.fit_transform(names)
+        except ValueError:
+            # Every n-gram is common (tiny or repetitive lists): keep them all
+            self.vectorizer.set_params(max_df=1.0)
+            matrix = self.vectorizer.fit_transform(names)
+        self.matrix = matrix.T.tocsc()
+
+    def top_k(self, queries, k, chunk_size=2048):
+        """Return a len(queries) x k array of candidate positions, padded with -1."""
+        candidates = np.full((len(queries), k), -1, dtype=np.int64)
+        for start in range(0, len(queries), chunk_size):
+            chunk = self.vectorizer.transform([str(q) for q in queries[start:start + chunk_size]])
+            similarities = (chunk @ self.matrix).tocsr()
+            for row in range(similarities.shape[0]):
+                row_start, row_end = similarities.indptr[row], similarities.indptr[row + 1]
+                positions = similarities.indices[row_start:row_end]
+                values = similarities.data[row_start:row_end]
+                if len(values) > k:
+                    keep = np.argpartition(-values, k - 1)[:k]
+                    positions = positions[keep]
+                # Keep candidates in list order so ties resolve as in a full scan
+                positions = np.sort(positions)
+                candidates[start + row, :len(positions)] = positions
+        return candidates
+
+
+class MatchingEngine:
+    """Score lists of names against each other as a score matrix.
+
+    The scorer can be a key of SCORERS or any rapidfuzz-compatible callable
+    returning a similarity between 0 and 1. Scores are reported on a 0-100
+    scale. Pairs scoring below score_cutoff are pruned (reported as 0), and
+    workers=-1 spreads the scoring over all cores.
+
+    With top_k set, best_matches first retrieves the top_k most similar names
+    from an NgramIndex and only scores those candidates, instead of scoring
+    every pair. Use candidate_recall to check how often that still finds the
+    exhaustive best match.
+
+    Queries are scored in chunks sized so the score matrices stay within
+    max_memory_mb, keeping only the best candidates of each chunk. With
+    processes set, the chunks are spread over a pool of worker processes.
+    progress, if given, is called with the share of queries scored so far,
+    at least every PROGRESS_ROWS queries.
+    stats['pairs_scored'] counts the name pairs actually scored, shared by
+    copies of the engine.
+    """
+
+    def __init__(self, scorer='jaro_winkler', score_cutoff=0, workers=-1, chunk_size=2048,
+                 top_k=None, ngram_range=(2, 3), ngram_max_df=0.1,
+                 processes=None, max_memory_mb=512, progress=None):
+        self.scorer_name = scorer if isinstance(scorer, str) else None
+        self.scorer = SCORERS[scorer] if isinstance(scorer, str) else scorer
+        self.score_cutoff = score_cutoff
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.top_k = top_k
+        self.ngram_range = ngram_range
+        self.ngram_max_df = ngram_max_df
+        self.processes = processes
+        self.max_memory_mb = max_memory_mb
+        self.progress = progress
+        self.stats = {'pairs_scored': 0}
+
+    def __getstate__(self):
+        # rapidfuzz scorers can't be pickled, so named scorers travel to
+        # worker processes by name (and progress callbacks stay behind)
+        state = self.__dict__.copy()
+        if self.scorer_name:
+            state['scorer'] = None
+        state['progress'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.scorer_name:
+            self.scorer = SCORERS[self.scorer_name]
+
+    def score_matrix(self, queries, choices):
+        """Return the len(queries) x len(choices) matrix of scores (0-100)."""
+        queries = [str(q) for q in queries]
+        choices = [str(c) for c in choices]
+        scores = process.cdist(
+            queries, choices,
+            scorer=self.scorer,
+            score_cutoff=self.score_cutoff / 100 if self.score_cutoff else None,
+            dtype=np.float64,
+            workers=self.workers
+        )
+        scores *= 100
+        self.stats['pairs_scored'] += len(queries) * len(choices)
+        # An empty name never counts as similar to anything
+        scores[[q == '' for q in queries], :] = 0
+        scores[:, [c == '' for c in choices]] = 0
+        return scores
+
+    def chunk_rows(self, n_choices):
+        """Number of queries to score at once so the score matrices fit in max_memory_mb.
+
+        The budget is shared by all worker processes, and every chunk needs
+        about two float64 matrices of len(chunk) x n_choices.
+        """
+        budget = self.max_memory_mb * 2 ** 20 / max(self.processes or 1, 1)
+        return int(max(1, min(self.chunk_size, budget // (max(n_choices, 1) * 8 * 2))))
+
+    def chunk_best_matches(self, queries, choices, index=None):
+        """best_matches for one chunk of queries, small enough to score at once."""
+        if index is not None:
+            return self.retrieved_best_matches(queries, choices, index)
+        scores = self.score_matrix(queries, choices)
+        best = scores.argmax(axis=1)
+        top = scores[np.arange(len(best)), best]
+        found = top > 0
+        return np.where(found, best, -1), np.where(found, top, 0)
+
+    def iter_best_matches(self, queries, choices):
+        """Yield (start, positions, scores) for consecutive chunks of queries as they finish.
+
+        Only one best candidate per query is kept from every chunk, so memory
+        stays bounded by max_memory_mb however long the lists are. With
+        processes set, the chunks are scored in a pool of that many worker
+        processes and may finish out of order.
+        """
+        queries = list(queries)
+        choices = list(choices)
+        if not queries or not choices:
+            return
+        index = None
+        rows = self.chunk_rows(len(choices))
+        if self.top_k and len(choices) > self.top_k:
+            index = NgramIndex(choices, self.ngram_range, self.ngram_max_df)
+            rows = self.chunk_size
+        if self.progress is not None:
+            rows = min(rows, PROGRESS_ROWS)
+        starts = range(0, len(queries), rows)
+
+        if not self.processes or len(starts) == 1:
+            for start in starts:
+                yield (start,) + self.chunk_best_matches(queries[start:start + rows], choices, index)
+            return
+
+        # Each worker gets the choices (and index) once and scores single-threaded
+        worker_engine = copy.copy(self)
+        worker_engine.processes = None
+        worker_engine.workers = 1
+        pool = ProcessPoolExecutor(self.processes, initializer=init_match_worker,
+                                   initargs=(worker_engine, choices, index))
+        try:
+            futures = {pool.submit(match_worker_chunk, queries[start:start + rows]): start for start in starts}
+            for future in as_completed(futures):
+                positions, scores, pairs_scored = future.result()
+                self.stats['pairs_scored'] += pairs_scored
+                yield futures[future], positions, scores
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    def best_matches(self, queries, choices):
+        """Return (positions, scores) of the best choice for every query.
+
+        The first best choice wins ties. Queries without any choice scoring
+        above 0 get position -1 and score 0. If the engine has a progress
+        callback, it is called with the share of queries done after each chunk.
+        """
+        queries = list(queries)
+        positions = np.full(len(queries), -1, dtype=np.int64)
+        best_scores = np.zeros(len(queries), dtype=np.float64)
+        done = 0
+        for start, chunk_positions, chunk_scores in self.iter_best_matches(queries, choices):
+            positions[start:start + len(chunk_positions)] = chunk_positions
+            best_scores[start:start + len(chunk_positions)] = chunk_scores
+            done += len(chunk_positions)
+            if self.progress is not None:
+                self.progress(done / len(queries))
+        return positions, best_scores
+
+    def score_pair(self, query, choice):
+        """Score a single pair of names (0-100)."""
+        query, choice = str(query), str(choice)
+        if query == '' or choice == '':
+            return 0.0
+        if self.score_cutoff:
+            return self.scorer(query, choice, score_cutoff=self.score_cutoff / 100) * 100
+        return self.scorer(query, choice) * 100
+
+    def retrieved_best_matches(self, queries, choices, index=None):
+        """best_matches over the top_k n-gram candidates of every query."""
+        choices = list(choices)
+        if index is None:
+            index = NgramIndex(choices, self.ngram_range, self.ngram_max_df)
+        candidates = index.top_k(queries, self.top_k, self.chunk_size)
+        self.stats['pairs_scored'] += int((candidates >= 0).sum())
+        positions = np.full(len(queries), -1, dtype=np.int64)
+        best_scores = np.zeros(len(queries), dtype=np.float64)
+        for i, (query, row) in enumerate(zip(queries, candidates)):
+            for position in row[row >= 0]:
+                score = self.score_pair(query, choices[position])
+                if score > best_scores[i]:
+                    best_scores[i] = score
+                    positions[i] = position
+        return positions, best_scores
+
+    def candidate_recall(self, queries, choices, sample_size=1000, seed=0):
+        """Share of queries for which top_k retrieval finds the exhaustive best score.
+
+        Queries are sampled (sample_size of them) to keep the exhaustive pass
+        cheap. Queries with no match at all in the exhaustive pass are left out.
+        The progress callback follows the exhaustive pass.
+        """
+        if not self.top_k or len(choices) <= self.top_k:
+            return 1.0
+        queries = list(queries)
+        if len(queries) > sample_size:
+            rng = np.random.default_rng(seed)
+            queries = [queries[i] for i in sorted(rng.choice(len(queries), sample_size, replace=False))]
+
+        exhaustive = copy.copy(self)
+        exhaustive.top_k = None
+        exhaustive.progress = self.progress
+        exhaustive_positions, exhaustive_scores = exhaustive.best_matches(queries, choices)
+        retrieved_positions, retrieved_scores = self.retrieved_best_matches(queries, choices)
+        found = exhaustive_positions >= 0
+        if not found.any():
+            return 1.0
+        return float(np.mean(np.isclose(retrieved_scores[found], exhaustive_scores[found])))
+
+    def part_engine(self, done, size, total):
+        """Copy of the engine for a part of size queries out of total, done of them already scored.
+
+        Its progress callback reports the share of all total queries, so
+        progress keeps counting up across blocks.
+        """
+        engine = copy.copy(self)
+        if self.progress is not None:
+            engine.progress = lambda share: self.progress((done + share * size) / total)
+        return engine
+
+    def blocked_best_matches(self, queries, choices, query_blocks, choice_blocks):
+        """Like best_matches, but only score queries against choices in the same block.
+
+        Blocks are any hashable keys (e.g. a district name), one per query and
+        one per choice. Queries whose block has no choices get position -1.
+        """
+        queries = list(queries)
+        choices = list(choices)
+        positions = np.full(len(queries), -1, dtype=np.int64)
+        best_scores = np.zeros(len(queries), dtype=np.float64)
+
+        choice_index = build_name_index(choice_blocks)
+        done = 0
+        for block, query_positions in build_name_index(query_blocks).items():
+            block_choices = choice_index.get(block)
+            block_engine = self.part_engine(done, len(query_positions), len(queries))
+            done += len(query_positions)
+            if not block_choices:
+                if block_engine.progress is not None:
+                    block_engine.progress(1.0)
+                continue
+            block_positions, block_scores = block_engine.best_matches(
+                [queries[i] for i in query_positions],
+                [choices[j] for j in block_choices]
+            )
+            found = block_positions >= 0
+            positions[query_positions] = np.where(found, np.take(block_choices, block_positions), -1)
+            best_scores[query_positions] = block_scores
+        return positions, best_scores
+
+    def candidate_pairs(self, queries, choices, floor, per_query=10):
+        """Return (query positions, choice positions, scores) of pairs scoring at least floor.
+
+        Only the per_query best candidates of every query are kept, so the
+        result stays sparse however long the lists are. With top_k set, the
+        candidates come from the n-gram index instead of a full scan. The
+        progress callback is called after each chunk, like in best_matches.
+        """
+        queries = list(queries)
+        choices = list(choices)
+        pair_rows, pair_cols, pair_scores = [], [], []
+        if not queries or not choices:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.int64), np.array([])
+
+        index = None
+        chunk_len = self.chunk_rows(len(choices))
+        if self.top_k and len(choices) > self.top_k:
+            index = NgramIndex(choices, self.ngram_range, self.ngram_max_df)
+            chunk_len = self.chunk_size
+        if self.progress is not None:
+            chunk_len = min(chunk_len, PROGRESS_ROWS)
+
+        def score_chunk(chunk):
+            # (candidate positions or None for all choices, scores) of a chunk of queries
+            if index is None:
+                return None, self.score_matrix(chunk, choices)
+            candidates = index.top_k(chunk, self.top_k, self.chunk_size)
+            scores = np.array([[self.score_pair(query, choices[p]) if p >= 0 else 0 for p in row]
+                               for query, row in zip(chunk, candidates)]).reshape(candidates.shape)
+            self.stats['pairs_scored'] += int((candidates >= 0).sum())
+            return candidates, scores
+
+        chunks = (
+            (start,) + score_chunk(queries[start:start + chunk_len])
+            for start in range(0, len(queries), chunk_len)
+        )
+
+        for start, candidates, scores in chunks:
+            if scores.shape[1] > per_query:
+                keep = np.argpartition(-scores, per_query - 1, axis=1)[:, :per_query]
+            else:
+                keep = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+            kept = np.take_along_axis(scores, keep, axis=1)
+            chunk_rows, chunk_cols = np.nonzero((kept >= floor) & (kept > 0))
+            positions = keep[chunk_rows, chunk_cols]
+            if candidates is not None:
+                positions = candidates[chunk_rows, positions]
+            pair_rows.append(chunk_rows + start)
+            pair_cols.append(positions)
+            pair_scores.append(kept[chunk_rows, chunk_cols])
+            if self.progress is not None:
+                self.progress((start + len(scores)) / len(queries))
+        return np.concatenate(pair_rows), np.concatenate(pair_cols), np.concatenate(pair_scores)
+
+    def blocked_candidate_pairs(self, queries, choices, floor, query_blocks, choice_blocks, per_query=10):
+        """Like candidate_pairs, but only pair queries with choices in the same block."""
+        queries = list(queries)
+        choices = list(choices)
+        pair_rows, pair_cols, pair_scores = [], [], []
+        choice_index = build_name_index(choice_blocks)
+        done = 0
+        for block, query_positions in build_name_index(query_blocks).items():
+            block_choices = choice_index.get(block)
+            block_engine = self.part_engine(done, len(query_positions), len(queries))
+            done += len(query_positions)
+            if not block_choices:
+                if block_engine.progress is not None:
+                    block_engine.progress(1.0)
+                continue
+            block_rows, block_cols, block_values = block_engine.candidate_pairs(
+                [queries[i] for i in query_positions],
+                [choices[j] for j in block_choices],
+                floor, per_query
+            )
+            pair_rows.append(np.take(query_positions, block_rows))
+            pair_cols.append(np.take(block_choices, block_cols))
+            pair_scores.append(block_values)
+        if not pair_rows:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.int64), np.array([])
+        return np.concatenate(pair_rows), np.concatenate(pair_cols), np.concatenate(pair_scores)
+
+
+# Per-process state of the matching workers started by MatchingEngine
+_worker_state = {}
+
+
+def init_match_worker(engine, choices, index):
+    """Keep the engine, choices and n-gram index in a worker process."""
+    _worker_state.update(engine=engine, choices=choices, index=index)
+
+
+def match_worker_chunk(queries):
+    """Score one chunk of queries in a worker process, returning the number of pairs scored with the matches."""
+    engine = _worker_state['engine']
+    before = engine.stats['pairs_scored']
+    positions, scores = engine.chunk_best_matches(queries, _worker_state['choices'], _worker_state['index'])
+    return positions, scores, engine.stats['pairs_scored'] - before
+
+
+def build_name_index(names):
+    """Map every name (or other key) to the list of positions where it occurs."""
+    index = {}
+    for position, name in enumerate(names):
+        index.setdefault(name, []).append(position)
+    return index
+
+
+def assign_one_to_one(n_queries, rows, cols, scores):
+    """Maximum-weight one-to-one matching over a sparse graph of candidate pairs.
+
+    rows, cols and scores list the candidate pairs (query position, choice
+    position, score > 0). Returns (positions, scores) per query like
+    MatchingEngine.best_matches, where no two queries share a choice and
+    unassigned queries get position -1 and score 0.
+    """
+    positions = np.full(n_queries, -1, dtype=np.int64)
+    best_scores = np.zeros(n_queries, dtype=np.float64)
+    if len(rows) == 0:
+        return positions, best_scores
+
+    # Keep the best score of duplicate pairs and renumber the queries and
+    # choices that have candidates at all
+    pairs = pd.DataFrame({'row': rows, 'col': cols, 'score': scores}).groupby(['row', 'col'])['score'].max()
+    query_ids, query_codes = np.unique(pairs.index.get_level_values('row'), return_inverse=True)
+    choice_ids, choice_codes = np.unique(pairs.index.get_level_values('col'), return_inverse=True)
+
+    # Every query also gets a private dummy choice with a negligible weight,
+    # so a full matching always exists and leaving a query unassigned is allowed
+    dummy_weight = pairs.min() * 1e-6
+    n_rows, n_cols = len(query_ids), len(choice_ids)
+    graph = sparse.csr_matrix(
+        (np.concatenate([pairs.to_numpy(), np.full(n_rows, dummy_weight)]),
+         (np.concatenate([query_codes, np.arange(n_rows)]),
+          np.concatenate([choice_codes, n_cols + np.arange(n_rows)]))),
+        shape=(n_rows, n_cols + n_rows)
+    )
+    row_ind, col_ind = min_weight_full_bipartite_matching(graph, maximize=True)
+
+    real = col_ind < n_cols
+    positions[query_ids[row_ind[real]]] = choice_ids[col_ind[real]]
+    best_scores[query_ids[row_ind[real]]] = np.asarray(graph[row_ind[real], col_ind[real]]).ravel()
+    return positions, best_scores
+
+
+def block_keys(df, cols):
+    """Return one blocking key per row: the given columns, trimmed and case-folded."""
+    if not cols:
+        return [()] * len(df)
+    keys = df[list(cols)].astype(str).apply(lambda col: col.str.strip().str.casefold())
+    return list(keys.itertuples(index=False, name=None))
+
+
+def take_prefixed(df, exclude_col, positions, prefix):
+    """Take rows of df by position (-1 gives an empty row) with prefixed column names."""
+    frame = df.drop(columns=exclude_col).reset_index(drop=True)
+    if len(positions) and positions.min() < 0:
+        frame = frame.reindex(positions).reset_index(drop=True)
+    else:
+        frame = frame.take(positions).reset_index(drop=True)
+    return frame.add_prefix(prefix)
+
+
+def assemble_results(df1, df2, name_col1, name_col2, mfl_positions, dhis2_positions, scores, statuses):
+    """Build the matching results table from one (MFL, DHIS2, score, status) entry per row.
+
+    Positions index into df1 and df2, with -1 where a row has no MFL or no
+    DHIS2 facility.
+    """
+    mfl_names = df1[name_col1].astype(str).to_numpy(dtype=object)
+    dhis2_names = df2[name_col2].to_numpy(dtype=object)
+    has_mfl = mfl_positions >= 0
+    has_dhis2 = dhis2_positions >= 0
+
+    hf_name_in_dhis2 = np.full(len(dhis2_positions), None, dtype=object)
+    hf_name_in_dhis2[has_dhis2] = dhis2_names[dhis2_positions[has_dhis2]]
+    # Matched names are reported as text, leftover DHIS2 names as uploaded
+    hf_name_in_dhis2[has_dhis2 & has_mfl] = [str(name) for name in hf_name_in_dhis2[has_dhis2 & has_mfl]]
+    hf_name_in_mfl = np.full(len(mfl_positions), None, dtype=object)
+    hf_name_in_mfl[has_mfl] = mfl_names[mfl_positions[has_mfl]]
+
+    results = pd.DataFrame({
+        'HF_Name_in_MFL': hf_name_in_mfl,
+        'HF_Name_in_DHIS2': hf_name_in_dhis2,
+        'Match_Score': scores,
+        'Match_Status': statuses
+    })
+    return pd.concat([
+        results,
+        take_prefixed(df1, name_col1, mfl_positions, 'MFL_'),
+        take_prefixed(df2, name_col2, dhis2_positions, 'DHIS2_')
+    ], axis=1)
+
+
+def one_to_one_matches(engine, names1, names2, name_index, blocks1, blocks2, exact, known,
+                       dhis2_positions, scores, fuzzy_names, fuzzy_blocks, to_score,
+                       threshold, block_on, national_fallback):
+    """Pair MFL and DHIS2 names one-to-one for calculate_match.
+
+    Exact and crosswalk matches enter the assignment as candidate pairs like
+    any fuzzy candidate. Returns (dhis2_positions, scores, statuses) per MFL name.
+    """
+    floor = max(threshold, 0)
+    rows, cols, values = [], [], []
+
+    for i in np.flatnonzero(exact):
+        # Every DHIS2 facility with the same name, preferably in the same block
+        same_block = [p for p in name_index[names1[i]] if blocks2[p] == blocks1[i]]
+        for position in same_block or name_index[names1[i]]:
+            rows.append(i)
+            cols.append(position)
+            values.append(100.0)
+    for i in np.flatnonzero(known):
+        if scores[i] >= floor and scores[i] > 0:
+            rows.append(i)
+            cols.append(dhis2_positions[i])
+            values.append(scores[i])
+
+    score_rows = np.flatnonzero(to_score)
+    if block_on:
+        fuzzy_rows, fuzzy_cols, fuzzy_values = engine.blocked_candidate_pairs(
+            fuzzy_names, names2, floor, fuzzy_blocks, blocks2)
+        if national_fallback:
+            # Names without a candidate in their block get national candidates
+            retry = np.setdiff1d(np.arange(len(fuzzy_names)), fuzzy_rows)
+            if len(retry):
+                retry_rows, retry_cols, retry_values = engine.candidate_pairs(
+                    [fuzzy_names[i] for i in retry], names2, floor)
+                fuzzy_rows = np.concatenate([fuzzy_rows, retry[retry_rows]])
+                fuzzy_cols = np.concatenate([fuzzy_cols, retry_cols])
+                fuzzy_values = np.concatenate([fuzzy_values, retry_values])
+    else:
+        fuzzy_rows, fuzzy_cols, fuzzy_values = engine.candidate_pairs(fuzzy_names, names2, floor)
+
+    positions, assigned_scores = assign_one_to_one(
+        len(names1),
+        np.concatenate([np.asarray(rows, dtype=np.int64), score_rows[fuzzy_rows]]),
+        np.concatenate([np.asarray(cols, dtype=np.int64), fuzzy_cols]),
+        np.concatenate([np.asarray(values, dtype=np.float64), fuzzy_values])
+    )
+    scores = np.round(assigned_scores, 2)
+    statuses = np.where((positions >= 0) & (assigned_scores >= threshold), 'Match', 'Unmatch').astype(object)
+    return positions, scores, statuses
+
+
+def calculate_match(df1, df2, name_col1, name_col2, threshold, engine=None,
+                    block_on=None, national_fallback=True, normalize=False, strip_types=False,
+                    crosswalk=None, one_to_one=False, matched_dhis2=None):
+    """Calculate matching scores between two dataframes using Jaro-Winkler similarity.
+
+    block_on is an optional list of (MFL column, DHIS2 column) pairs, e.g.
+    [('district', 'orgunitlevel2')]. When given, names are only scored against
+    DHIS2 facilities with the same values in those columns, and exact matches
+    prefer a facility in the same block. With national_fallback, names left
+    unmatched within their block are scored against the whole DHIS2 list.
+
+    With normalize, both exact matching and fuzzy scoring run on the
+    canonical names from normalize_name; the results still show the names as
+    uploaded.
+
+    crosswalk is an optional CrosswalkStore. Names whose saved DHIS2 partner
+    is still in the DHIS2 list and scored at least the threshold (with the
+    same scorer) are resolved from it without scoring, and new fuzzy matches
+    are saved to it. results.attrs['crosswalk_hits'] holds the
+    number of names resolved this way, and results.attrs['pairs_scored'] the
+    number of name pairs the engine actually scored.
+
+    With one_to_one, every DHIS2 facility is matched to at most one MFL name:
+    candidate pairs scoring at least the threshold form a sparse graph and the
+    maximum-weight one-to-one assignment over it decides the matches. Names
+    left without a partner are reported as unmatched.
+    """
+    if engine is None:
+        engine = MatchingEngine()
+    # Count the pairs scored by this call alone (copies leave progress behind)
+    progress = engine.progress
+    engine = copy.copy(engine)
+    engine.progress = progress
+    engine.stats = {'pairs_scored': 0}
+    block_on = list(block_on or [])
+
+    # Index the DHIS2 names once so exact matches are a dict lookup
+    names1 = match_forms(df1[name_col1], normalize, strip_types)
+    names2 = match_forms(df2[name_col2], normalize, strip_types)
+    name_index = build_name_index(names2)
+    blocks1 = block_keys(df1, [col1 for col1, col2 in block_on])
+    blocks2 = block_keys(df2, [col2 for col1, col2 in block_on])
+
+    def in_reach(name, block):
+        # Whether a DHIS2 facility with this name may be matched from this
+        # block: one in the same block, or any with the national fallback
+        return name in name_index and (national_fallback or any(blocks2[p] == block for p in name_index[name]))
+
+    # Exact matches outside the block are left to the blocked scorer
+    exact = np.array([in_reach(name, block) for name, block in zip(names1, blocks1)], dtype=bool)
+
+    def block_position(name, block):
+        # First DHIS2 facility with this name, preferably in the same block
+        return next((p for p in name_index[name] if blocks2[p] == block), name_index[name][0])
+
+    dhis2_positions = np.full(len(names1), -1, dtype=np.int64)
+    scores = np.full(len(names1), 100, dtype=np.float64)
+    dhis2_positions[exact] = [block_position(name, block)
+                              for name, block, is_exact in zip(names1, blocks1, exact) if is_exact]
+
+    # Resolve names accepted in earlier runs from the crosswalk
+    known = np.zeros(len(names1), dtype=bool)
+    # Scores of different scorers can't be compared, so each has its own pairs
+    name_form = ('normalized_no_type' if strip_types else 'normalized') if normalize else 'raw'
+    name_form += '/' + (engine.scorer_name or getattr(engine.scorer, '__qualname__', 'custom'))
+    if crosswalk is not None:
+        saved = crosswalk.lookup([name for name, is_exact in zip(names1, exact) if not is_exact], name_form)
+        for i, (name, block) in enumerate(zip(names1, blocks1)):
+            # Pairs saved by runs at a lower threshold are scored again
+            if not exact[i] and name in saved and saved[name][1] >= threshold and in_reach(saved[name][0], block):
+                known[i] = True
+                dhis2_positions[i] = block_position(saved[name][0], block)
+                scores[i] = saved[name][1]
+
+    # Score every remaining name in a single pass
+    to_score = ~exact & ~known
+    fuzzy_names = [name for name, needs_score in zip(names1, to_score) if needs_score]
+    fuzzy_blocks = [block for block, needs_score in zip(blocks1, to_score) if needs_score]
+    if one_to_one:
+        dhis2_positions, scores, statuses = one_to_one_matches(
+            engine, names1, names2, name_index, blocks1, blocks2, exact, known, dhis2_positions, scores,
+            fuzzy_names, fuzzy_blocks, to_score, threshold, block_on, national_fallback
+        )
+        fuzzy_positions, fuzzy_scores = dhis2_positions[to_score], scores[to_score]
+    else:
+        if block_on:
+            fuzzy_positions, fuzzy_scores = engine.blocked_best_matches(fuzzy_names, names2, fuzzy_blocks, blocks2)
+            if national_fallback:
+                # Give names still unmatched within their block a national search
+                retry = np.flatnonzero(fuzzy_scores < threshold)
+                if len(retry):
+                    fuzzy_positions[retry], fuzzy_scores[retry] = engine.best_matches(
+                        [fuzzy_names[i] for i in retry], names2
+                    )
+        else:
+            fuzzy_positions, fuzzy_scores = engine.best_matches(fuzzy_names, names2)
+
+        dhis2_positions[to_score] = fuzzy_positions
+        scores[to_score] = np.round(fuzzy_scores, 2)
+        statuses = np.full(len(names1), 'Match', dtype=object)
+        statuses[to_score] = np.where(fuzzy_scores < threshold, 'Unmatch', 'Match')
+        statuses[known] = np.where(scores[known] < threshold, 'Unmatch', 'Match')
+
+    if crosswalk is not None:
+        accepted = np.flatnonzero(to_score)[(fuzzy_scores >= threshold) & (fuzzy_positions >= 0)]
+        crosswalk.save([(names1[i], names2[dhis2_positions[i]], scores[i]) for i in accepted], name_form)
+
+    # Handle unmatched facilities from DHIS2
+    if one_to_one:
+        # Facilities are paired individually, so leftovers are the unpaired rows
+        paired = set(dhis2_positions[dhis2_positions >= 0].tolist())
+        leftover = np.array([position for position in range(len(names2)) if position not in paired],
+                            dtype=np.int64)
+    else:
+        matched_dhis2_names = {names2[position] for position in dhis2_positions if position >= 0}
+        if matched_dhis2 is not None:
+            # The caller collects matched names and adds the leftovers itself
+            matched_dhis2.update(matched_dhis2_names)
+            matched_dhis2_names = set(names2)
+        leftover = np.array([position for position, value2 in enumerate(names2)
+                             if value2 not in matched_dhis2_names], dtype=np.int64)
+
+    results = assemble_results(
+        df1, df2, name_col1, name_col2,
+        mfl_positions=np.concatenate([np.arange(len(names1)), np.full(len(leftover), -1)]),
+        dhis2_positions=np.concatenate([dhis2_positions, leftover]),
+        scores=np.concatenate([scores, np.zeros(len(leftover))]),
+        statuses=np.concatenate([statuses, np.full(len(leftover), 'Unmatch', dtype=object)])
+    )
+    results.attrs['crosswalk_hits'] = int(known.sum())
+    results.attrs['pairs_scored'] = engine.stats['pairs_scored']
+    return results
+
+
+def add_suggested_names(results, threshold):
+    """Add the Suggested_HF_Name column: the DHIS2 name for matches, else the MFL name."""
+    results['Suggested_HF_Name'] = np.where(
+        results['Match_Score'] >= threshold,
+        results['HF_Name_in_DHIS2'],
+        results['HF_Name_in_MFL']
+    )
+    return results
+
+
+def leftover_results(df1, df2, name_col1, name_col2, matched_dhis2, normalize=False, strip_types=False):
+    """Results rows for the DHIS2 facilities whose names are not in matched_dhis2.
+
+    Companion of calculate_match(matched_dhis2=...) for chunked matching; df1
+    (any chunk of the MFL list) only provides the MFL columns.
+    """
+    names2 = match_forms(df2[name_col2], normalize, strip_types)
+    leftover = np.array([position for position, value2 in enumerate(names2)
+                         if value2 not in matched_dhis2], dtype=np.int64)
+    return assemble_results(
+        df1.iloc[:0], df2, name_col1, name_col2,
+        mfl_positions=np.full(len(leftover), -1, dtype=np.int64),
+        dhis2_positions=leftover,
+        scores=np.zeros(len(leftover)),
+        statuses=np.full(len(leftover), 'Unmatch', dtype=object)
+    )
+
+
+def frame_fingerprint(df):
+    """Content hash of a dataframe's column names and values."""
+    digest = hashlib.sha256(repr(list(df.columns)).encode())
+    try:
+        row_hashes = pd.util.hash_pandas_object(df, index=False)
+    except TypeError:
+        # Unhashable cell values (e.g. lists): hash their text instead
+        row_hashes = pd.util.hash_pandas_object(df.astype(str), index=False)
+    digest.update(row_hashes.to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+def match_cache_key(df1, df2, **settings):
+    """Key identifying a matching run: both input frames plus the settings that shape the scores."""
+    digest = hashlib.sha256(frame_fingerprint(df1).encode())
+    digest.update(frame_fingerprint(df2).encode())
+    digest.update(repr(sorted(settings.items())).encode())
+    return digest.hexdigest()
+
+
+def reclassify(results, threshold):
+    """Re-apply a threshold to calculate_match results without scoring again.
+
+    Only valid for results whose matches did not depend on the threshold
+    (i.e. not one_to_one, and no national fallback after blocking).
+    Leftover DHIS2 rows stay unmatched.
+    """
+    results = results.copy()
+    has_mfl = results['HF_Name_in_MFL'].notna()
+    results.loc[has_mfl, 'Match_Status'] = np.where(
+        results.loc[has_mfl, 'Match_Score'] < threshold, 'Unmatch', 'Match')
+    return results
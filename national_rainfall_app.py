@@ -1,9 +1,9 @@
 import streamlit as st
-import geopandas as gpd
-import pandas as pd
 import matplotlib.pyplot as plt
-from shapely.geometry import Point
 import numpy as np
+from boundaries import pick_tolerance, simplify_coverage
+from facilities import AssignmentStore, coordinate_issue_summary, district_facilities_by_chiefdom, facility_points
+from ingest import BOUNDARY_FILE_TYPES, read_boundaries, read_excel
 
 st.set_page_config(layout="wide", page_title="Health Facility Map Generator")
 
@@ -15,9 +15,12 @@ col1, col2 = st.columns(2)
 
 with col1:
     st.header("Upload Shapefiles")
-    shp_file = st.file_uploader("Upload .shp file", type=["shp"], key="shp")
-    shx_file = st.file_uploader("Upload .shx file", type=["shx"], key="shx")
-    dbf_file = st.file_uploader("Upload .dbf file", type=["dbf"], key="dbf")
+    boundary_files = st.file_uploader(
+        "Upload a zipped shapefile, GeoPackage or GeoJSON (or the .shp, .shx and .dbf files)",
+        type=BOUNDARY_FILE_TYPES,
+        accept_multiple_files=True,
+        key="boundaries"
+    )
 
 with col2:
     st.header("Upload Health Facility Data")
@@ -47,27 +50,21 @@ with col5:
     show_chiefdom_name = st.checkbox("Show Chiefdom Name", value=True)
 
 # Check if all required files are uploaded
-if all([shp_file, shx_file, dbf_file, facility_file]):
+if all([boundary_files, facility_file]):
     try:
-        # Read shapefiles
-        with open("temp.shp", "wb") as f:
-            f.write(shp_file.read())
-        with open("temp.shx", "wb") as f:
-            f.write(shx_file.read())
-        with open("temp.dbf", "wb") as f:
-            f.write(dbf_file.read())
-        shapefile = gpd.read_file("temp.shp")
+        # Read the boundaries from memory (parsed once per upload, then cached)
+        shapefile = read_boundaries(boundary_files)
 
         # Read facility data
-        facility_data = pd.read_excel(facility_file)
+        facility_data = read_excel(facility_file)
 
-        # Convert facility data to GeoDataFrame
-        geometry = [Point(xy) for xy in zip(facility_data['w_long'], facility_data['w_lat'])]
-        facilities_gdf = gpd.GeoDataFrame(
-            facility_data, 
-            geometry=geometry,
-            crs="EPSG:4326"
-        )
+        # Convert facility data to GeoDataFrame, flagging bad coordinates
+        facilities_gdf = facility_points(facility_data)
+
+        # Report facilities whose coordinates are missing, swapped or outside the country
+        coordinate_issues = coordinate_issue_summary(facilities_gdf)
+        if coordinate_issues:
+            st.warning(f"Facility coordinates needing attention: {coordinate_issues}")
 
         # Get unique districts from shapefile
         districts = sorted(shapefile['FIRST_DNAM'].unique())
@@ -76,6 +73,13 @@ if all([shp_file, shx_file, dbf_file, facility_file]):
         # Filter shapefile for selected district
         district_shapefile = shapefile[shapefile['FIRST_DNAM'] == selected_district]
         
+        # Assign every facility to its chiefdom once, against all chiefdoms, and
+        # split the selected district's facilities by chiefdom. Assignments are
+        # saved, so reruns (e.g. switching district) and re-uploads only locate
+        # new or moved facilities
+        district_facilities, facilities_by_chiefdom = district_facilities_by_chiefdom(
+            facilities_gdf, shapefile, selected_district, store=AssignmentStore())
+
         # Get unique chiefdoms for the selected district
         chiefdoms = sorted(district_shapefile['FIRST_CHIE'].unique())
         
@@ -87,6 +91,11 @@ if all([shp_file, shx_file, dbf_file, facility_file]):
         fig = plt.figure(figsize=(20, 25))  # Increased height to accommodate 5 rows
         fig.suptitle(map_title, fontsize=24, y=0.98)  # Increased y value for more space
 
+        # Simplified copies of the district's chiefdoms for drawing, by tolerance
+        # (the spatial join below keeps the full-resolution polygons)
+        district_levels = {}
+        subplot_size = (20 / n_cols, 25 / n_rows)
+
         # Plot each chiefdom
         for idx, chiefdom in enumerate(chiefdoms[:20]):  # Limit to 20 chiefdoms (5x4 grid)
             if idx >= n_rows * n_cols:
@@ -98,16 +107,16 @@ if all([shp_file, shx_file, dbf_file, facility_file]):
             # Filter shapefile for current chiefdom
             chiefdom_shapefile = district_shapefile[district_shapefile['FIRST_CHIE'] == chiefdom]
             
-            # Plot chiefdom boundary
-            chiefdom_shapefile.plot(ax=ax, color=background_color, edgecolor='black', linewidth=0.5)
+            # Plot chiefdom boundary, at the simplest level of detail that looks
+            # the same in its subplot of the map saved at 300 dpi
+            tolerance = pick_tolerance(chiefdom_shapefile.total_bounds, subplot_size, 300)
+            if tolerance not in district_levels:
+                district_levels[tolerance] = simplify_coverage(district_shapefile, tolerance)
+            district_level = district_levels[tolerance]
+            district_level[district_level['FIRST_CHIE'] == chiefdom].plot(ax=ax, color=background_color, edgecolor='black', linewidth=0.5)
             
-            # Spatial join to get facilities within the chiefdom
-            chiefdom_facilities = gpd.sjoin(
-                facilities_gdf,
-                chiefdom_shapefile,
-                how="inner",
-                predicate="within"
-            )
+            # Facilities within the chiefdom
+            chiefdom_facilities = facilities_by_chiefdom.get(chiefdom, district_facilities.iloc[:0])
             
             # Plot facilities
             if len(chiefdom_facilities) > 0:
@@ -169,8 +178,8 @@ if all([shp_file, shx_file, dbf_file, facility_file]):
 
         with col7:
             # Export facility data
-            if len(chiefdom_facilities) > 0:
-                csv = chiefdom_facilities.to_csv(index=False)
+            if len(district_facilities) > 0:
+                csv = district_facilities.to_csv(index=False)
                 st.download_button(
                     label="Download Processed Data (CSV)",
                     data=csv,
@@ -1,8 +1,8 @@
 import streamlit as st
-import geopandas as gpd
 import pandas as pd
 import matplotlib.pyplot as plt
-from shapely.geometry import Point
+from facilities import coordinate_issue_summary, facility_points, usable_facilities
+from ingest import BOUNDARY_FILE_TYPES, read_boundaries, read_excel
 import numpy as np
 from matplotlib.colors import LinearSegmentedColormap
 
@@ -16,28 +16,25 @@ col1, col2 = st.columns(2)
 
 with col1:
     st.header("Upload Shapefiles")
-    shp_file = st.file_uploader("Upload .shp file", type=["shp"], key="shp")
-    shx_file = st.file_uploader("Upload .shx file", type=["shx"], key="shx")
-    dbf_file = st.file_uploader("Upload .dbf file", type=["dbf"], key="dbf")
+    boundary_files = st.file_uploader(
+        "Upload a zipped shapefile, GeoPackage or GeoJSON (or the .shp, .shx and .dbf files)",
+        type=BOUNDARY_FILE_TYPES,
+        accept_multiple_files=True,
+        key="boundaries"
+    )
 
 with col2:
     st.header("Upload Health Facility Data")
     facility_file = st.file_uploader("Upload Excel file (.xlsx)", type=["xlsx"], key="facility")
 
 # Check if all required files are uploaded
-if all([shp_file, shx_file, dbf_file, facility_file]):
+if all([boundary_files, facility_file]):
     try:
-        # Read shapefiles
-        with open("temp.shp", "wb") as f:
-            f.write(shp_file.read())
-        with open("temp.shx", "wb") as f:
-            f.write(shx_file.read())
-        with open("temp.dbf", "wb") as f:
-            f.write(dbf_file.read())
-        shapefile = gpd.read_file("temp.shp")
+        # Read the boundaries from memory (parsed once per upload, then cached)
+        shapefile = read_boundaries(boundary_files)
 
         # Read facility data
-        coordinates_data = pd.read_excel(facility_file)
+        coordinates_data = read_excel(facility_file)
 
         # Display data preview
         st.subheader("Data Preview")
@@ -76,23 +73,19 @@ if all([shp_file, shx_file, dbf_file, facility_file]):
             point_color = st.selectbox("Point Color", point_colors)
 
         # Data processing
-        # Remove missing coordinates
-        coordinates_data = coordinates_data.dropna(subset=[longitude_col, latitude_col])
-        
-        # Filter invalid coordinates
-        coordinates_data = coordinates_data[
-            (coordinates_data[longitude_col].between(-180, 180)) &
-            (coordinates_data[latitude_col].between(-90, 90))
-        ]
-
-        if len(coordinates_data) == 0:
+        # Convert to GeoDataFrame, dropping missing, invalid and out-of-country
+        # coordinates (swapped longitude/latitude are fixed)
+        coordinates_gdf = facility_points(coordinates_data, longitude_col, latitude_col)
+        coordinate_issues = coordinate_issue_summary(coordinates_gdf)
+        if coordinate_issues:
+            st.warning(f"Facility coordinates needing attention: {coordinate_issues}")
+        coordinates_gdf = usable_facilities(coordinates_gdf)
+        coordinates_data = pd.DataFrame(coordinates_gdf.drop(columns='geometry'))
+
+        if len(coordinates_gdf) == 0:
             st.error("No valid coordinates found in the data after filtering.")
             st.stop()
 
-        # Convert to GeoDataFrame
-        geometry = [Point(xy) for xy in zip(coordinates_data[longitude_col], coordinates_data[latitude_col])]
-        coordinates_gdf = gpd.GeoDataFrame(coordinates_data, geometry=geometry, crs="EPSG:4326")
-
         # Ensure consistent CRS
         if shapefile.crs is None:
             shapefile = shapefile.set_crs(epsg=4326)
@@ -1,83 +1,29 @@
 import streamlit as st
 import pandas as pd
-import numpy as np
-from jellyfish import jaro_winkler_similarity
+import os
+import time
 from io import BytesIO
+from crosswalk import CrosswalkStore
+from ingest import read_table
+from matching_jobs import forget_job, get_job, submit_match_job
+from name_matching import MatchingEngine, add_suggested_names, match_cache_key, reclassify
 
-def calculate_match(df1, df2, name_col1, name_col2, threshold):
-    """Calculate matching scores between two dataframes using Jaro-Winkler similarity."""
-    results = []
-    
-    for idx1, row1 in df1.iterrows():
-        value1 = str(row1[name_col1])
-        if value1 in df2[name_col2].astype(str).values:
-            # Exact match found
-            matching_row = df2[df2[name_col2].astype(str) == value1].iloc[0]
-            result_dict = {
-                'HF_Name_in_MFL': value1,
-                'HF_Name_in_DHIS2': value1,
-                'Match_Score': 100,
-                'Match_Status': 'Match'
-            }
-            # Add all columns from both datasets
-            for col in df1.columns:
-                if col != name_col1:
-                    result_dict[f'MFL_{col}'] = row1[col]
-            for col in df2.columns:
-                if col != name_col2:
-                    result_dict[f'DHIS2_{col}'] = matching_row[col]
-            results.append(result_dict)
-        else:
-            # Find best match
-            best_score = 0
-            best_match = None
-            best_match_row = None
-            
-            for idx2, row2 in df2.iterrows():
-                value2 = str(row2[name_col2])
-                similarity = jaro_winkler_similarity(value1, value2) * 100
-                if similarity > best_score:
-                    best_score = similarity
-                    best_match = value2
-                    best_match_row = row2
-            
-            result_dict = {
-                'HF_Name_in_MFL': value1,
-                'HF_Name_in_DHIS2': best_match,
-                'Match_Score': round(best_score, 2),
-                'Match_Status': 'Unmatch' if best_score < threshold else 'Match'
-            }
-            # Add all columns from both datasets
-            for col in df1.columns:
-                if col != name_col1:
-                    result_dict[f'MFL_{col}'] = row1[col]
-            if best_match_row is not None:
-                for col in df2.columns:
-                    if col != name_col2:
-                        result_dict[f'DHIS2_{col}'] = best_match_row[col]
-            results.append(result_dict)
-    
-    # Handle unmatched facilities from DHIS2
-    matched_dhis2_names = [r['HF_Name_in_DHIS2'] for r in results if r['HF_Name_in_DHIS2'] is not None]
-    for idx2, row2 in df2.iterrows():
-        if str(row2[name_col2]) not in matched_dhis2_names:
-            result_dict = {
-                'HF_Name_in_MFL': None,
-                'HF_Name_in_DHIS2': row2[name_col2],
-                'Match_Score': 0,
-                'Match_Status': 'Unmatch'
-            }
-            # Add empty values for MFL columns
-            for col in df1.columns:
-                if col != name_col1:
-                    result_dict[f'MFL_{col}'] = None
-            # Add DHIS2 columns
-            for col in df2.columns:
-                if col != name_col2:
-                    result_dict[f'DHIS2_{col}'] = row2[col]
-            results.append(result_dict)
-    
-    return pd.DataFrame(results)
+# Step 3 matching settings, by widget key. They are kept in session state so
+# a reloaded page can restore them along with a running matching job.
+MATCH_SETTING_DEFAULTS = {
+    'match_threshold': 70,
+    'match_normalize': True,
+    'match_strip_types': False,
+    'match_use_blocking': False,
+    'match_national_fallback': True,
+    'match_one_to_one': False,
+    'match_top_k': 0,
+    'match_processes': 0,
+    'match_max_memory_mb': 512,
+    'match_use_crosswalk': False,
+}
+MATCH_SETTING_KEYS = list(MATCH_SETTING_DEFAULTS) + ['match_mfl_col', 'match_dhis2_col',
+                                                     'match_mfl_block_cols', 'match_dhis2_block_cols']
 
 def main():
     st.title("Health Facility Name Matching Tool")
@@ -107,6 +53,16 @@ def main():
         st.session_state.master_hf_list = None
     if 'health_facilities_dhis2_list' not in st.session_state:
         st.session_state.health_facilities_dhis2_list = None
+    if 'match_job_id' not in st.session_state:
+        st.session_state.match_job_id = None
+
+    # A reloaded page starts a new session; pick its matching job up again from the URL
+    if st.session_state.match_job_id is None and get_job(st.query_params.get('match_job')) is not None:
+        job = get_job(st.query_params['match_job'])
+        st.session_state.match_job_id = job.id
+        st.session_state.master_hf_list, st.session_state.health_facilities_dhis2_list = job.meta['inputs']
+        st.session_state.update(job.meta['settings'])
+        st.session_state.step = 3
 
     # Rest of your existing code for Step 1...
     if st.session_state.step == 1:
@@ -116,16 +72,10 @@ def main():
 
         if mfl_file and dhis2_file:
             try:
-                # Read files
-                if mfl_file.name.endswith('.csv'):
-                    st.session_state.master_hf_list = pd.read_csv(mfl_file)
-                else:
-                    st.session_state.master_hf_list = pd.read_excel(mfl_file)
-
-                if dhis2_file.name.endswith('.csv'):
-                    st.session_state.health_facilities_dhis2_list = pd.read_csv(dhis2_file)
-                else:
-                    st.session_state.health_facilities_dhis2_list = pd.read_excel(dhis2_file)
+                # Read files (with the fastest available parser, once per upload;
+                # names stay plain Python strings for the matcher)
+                st.session_state.master_hf_list = read_table(mfl_file, strings='object')
+                st.session_state.health_facilities_dhis2_list = read_table(dhis2_file, strings='object')
 
                 st.success("Files uploaded successfully!")
                 
@@ -176,78 +126,200 @@ def main():
     # Step 3: Column Selection and Matching
     elif st.session_state.step == 3:
         st.header("Step 3: Select Columns for Matching")
+        for key, value in MATCH_SETTING_DEFAULTS.items():
+            st.session_state.setdefault(key, value)
         
         mfl_col = st.selectbox("Select HF Name column in Master HF List:", 
-                              st.session_state.master_hf_list.columns)
+                              st.session_state.master_hf_list.columns, key='match_mfl_col')
         dhis2_col = st.selectbox("Select HF Name column in DHIS2 HF List:", 
-                                st.session_state.health_facilities_dhis2_list.columns)
+                                st.session_state.health_facilities_dhis2_list.columns, key='match_dhis2_col')
         
         threshold = st.slider("Set Match Threshold (0-100):", 
-                            min_value=0, max_value=100, value=70,
+                            min_value=0, max_value=100, key='match_threshold',
                             help="Higher threshold means stricter matching criteria")
 
-        if st.button("Perform Matching"):
-            # Process data
-            master_hf_list_clean = st.session_state.master_hf_list.copy()
-            dhis2_list_clean = st.session_state.health_facilities_dhis2_list.copy()
-            
-            master_hf_list_clean[mfl_col] = master_hf_list_clean[mfl_col].astype(str)
-            master_hf_list_clean = master_hf_list_clean.drop_duplicates(subset=[mfl_col])
-            dhis2_list_clean[dhis2_col] = dhis2_list_clean[dhis2_col].astype(str)
+        # Name normalization
+        normalize = st.checkbox("Normalize names before matching", key='match_normalize',
+                                help="Ignore case, punctuation and spelling variants such as Govt./Government "
+                                     "or Hosp/Hospital")
+        strip_types = st.checkbox("Ignore facility type (CHC, MCHP, CHP, Hospital, Clinic)", key='match_strip_types',
+                                  disabled=not normalize)
+
+        # Optional blocking: only compare facilities within the same district/chiefdom
+        use_blocking = st.checkbox("Only match facilities within the same district/chiefdom", key='match_use_blocking',
+                                   help="Names are only compared with DHIS2 facilities that share the selected columns")
+        block_on = []
+        national_fallback = False
+        if use_blocking:
+            col1, col2 = st.columns(2)
+            mfl_block_cols = col1.multiselect("Blocking columns in Master HF List:",
+                                              [c for c in st.session_state.master_hf_list.columns if c != mfl_col],
+                                              key='match_mfl_block_cols')
+            dhis2_block_cols = col2.multiselect("Blocking columns in DHIS2 HF List:",
+                                                [c for c in st.session_state.health_facilities_dhis2_list.columns
+                                                 if c != dhis2_col],
+                                                key='match_dhis2_block_cols')
+            if len(mfl_block_cols) != len(dhis2_block_cols):
+                st.warning("Select the same number of blocking columns in both lists, in matching order.")
+            else:
+                block_on = list(zip(mfl_block_cols, dhis2_block_cols))
+            national_fallback = st.checkbox("Search the whole country for names unmatched within their block",
+                                            key='match_national_fallback')
+
+        # Optimal one-to-one assignment instead of each name taking its best candidate
+        one_to_one = st.checkbox("Match each DHIS2 facility at most once (optimal assignment)", key='match_one_to_one',
+                                 help="Pairs names so that no two MFL facilities claim the same DHIS2 facility, "
+                                      "maximizing the total match score")
+
+        # Settings for very large lists
+        with st.expander("Performance settings (large lists)"):
+            top_k = st.number_input("Candidates per name (0 = compare with every DHIS2 name):",
+                                    min_value=0, step=5, key='match_top_k',
+                                    help="For very large lists, only the most similar DHIS2 names (by shared "
+                                         "character n-grams) are scored. Higher values are slower but miss fewer "
+                                         "matches.")
+            processes = st.number_input("Worker processes (0 = score in the app process):",
+                                        min_value=0, max_value=os.cpu_count() or 1, key='match_processes')
+            max_memory_mb = st.number_input("Memory limit for scoring (MB):", min_value=64, step=64,
+                                            key='match_max_memory_mb')
+        engine = MatchingEngine(top_k=int(top_k) or None, processes=int(processes) or None,
+                                max_memory_mb=int(max_memory_mb))
+
+        # Crosswalk of matches accepted in earlier runs
+        crosswalk = CrosswalkStore()
+        use_crosswalk = st.checkbox(f"Reuse matches saved from previous runs ({len(crosswalk)} saved)",
+                                    key='match_use_crosswalk',
+                                    help="Names matched before are looked up instead of scored again; "
+                                         "new matches above the threshold are saved")
+        if st.button("Clear Saved Matches"):
+            crosswalk.clear()
+            st.experimental_rerun()
+
+        # Process data
+        master_hf_list_clean = st.session_state.master_hf_list.copy()
+        dhis2_list_clean = st.session_state.health_facilities_dhis2_list.copy()
+
+        master_hf_list_clean[mfl_col] = master_hf_list_clean[mfl_col].astype(str)
+        master_hf_list_clean = master_hf_list_clean.drop_duplicates(
+            subset=[mfl_col] + [col1 for col1, col2 in block_on])
+        dhis2_list_clean[dhis2_col] = dhis2_list_clean[dhis2_col].astype(str)
+
+        # Results are cached per input and settings; the threshold is only part of
+        # the key when it changes which candidates are picked, otherwise moving the
+        # slider just re-classifies the cached scores
+        settings = dict(mfl_col=mfl_col, dhis2_col=dhis2_col, block_on=block_on,
+                        national_fallback=national_fallback, normalize=normalize, strip_types=strip_types,
+                        one_to_one=one_to_one, top_k=engine.top_k, use_crosswalk=use_crosswalk)
+        if one_to_one or (block_on and national_fallback):
+            settings['threshold'] = threshold
+        cache_key = match_cache_key(master_hf_list_clean, dhis2_list_clean, **settings)
+        cached = st.session_state.get('match_cache')
+
+        # Collect the result of a matching job that finished since the last rerun
+        job = get_job(st.session_state.match_job_id)
+        if job is not None and job.status != 'running':
+            if job.status == 'done':
+                cached = st.session_state.match_cache = dict(job.result(), key=job.meta['key'])
+            elif job.status == 'cancelled':
+                st.warning("Matching was cancelled.")
+            else:
+                st.error(f"Matching failed: {job.error}")
+            forget_job(job.id)
+            st.session_state.match_job_id = None
+            st.query_params.pop('match_job', None)
+            job = None
+
+        running = job is not None
+        if st.button("Perform Matching", disabled=running) and (cached is None or cached['key'] != cache_key):
+            # Match in a background job, so the page stays responsive and the
+            # job survives reruns (and page reloads, through the URL)
+            job = submit_match_job(
+                master_hf_list_clean,
+                dhis2_list_clean,
+                mfl_col,
+                dhis2_col,
+                threshold,
+                engine,
+                meta={
+                    'key': cache_key,
+                    'inputs': (st.session_state.master_hf_list, st.session_state.health_facilities_dhis2_list),
+                    'settings': {key: st.session_state[key] for key in MATCH_SETTING_KEYS if key in st.session_state}
+                },
+                block_on=block_on,
+                national_fallback=national_fallback,
+                normalize=normalize,
+                strip_types=strip_types,
+                crosswalk=crosswalk if use_crosswalk else None,
+                one_to_one=one_to_one
+            )
+            st.session_state.match_job_id = job.id
+            st.query_params['match_job'] = job.id
+            running = True
+
+        if running:
+            st.progress(job.progress, text=f"Scoring names... {job.progress:.0%}")
+            if st.button("Cancel Matching"):
+                job.cancel()
+
+        if cached is not None and cached['key'] == cache_key:
+            hf_name_match_results = reclassify(cached['results'], threshold)
 
             st.write("### Counts of Health Facilities")
             st.write(f"Count of HFs in DHIS2 list: {len(dhis2_list_clean)}")
             st.write(f"Count of HFs in MFL list: {len(master_hf_list_clean)}")
 
-            # Perform matching
-            with st.spinner("Performing matching..."):
-                hf_name_match_results = calculate_match(
-                    master_hf_list_clean,
-                    dhis2_list_clean,
-                    mfl_col,
-                    dhis2_col,
-                    threshold
-                )
-                
-                # Add suggested name column
-                hf_name_match_results['Suggested_HF_Name'] = np.where(
-                    hf_name_match_results['Match_Score'] >= threshold,
-                    hf_name_match_results['HF_Name_in_DHIS2'],
-                    hf_name_match_results['HF_Name_in_MFL']
-                )
-
-                # Display results
-                st.write("### Matching Results")
-                st.dataframe(hf_name_match_results)
-                
-                # Add summary statistics
-                total_facilities = len(hf_name_match_results)
-                matched = len(hf_name_match_results[hf_name_match_results['Match_Status'] == 'Match'])
-                unmatched = total_facilities - matched
-                
-                st.write("### Summary Statistics")
-                col1, col2, col3 = st.columns(3)
-                col1.metric("Total Facilities", total_facilities)
-                col2.metric("Matched", matched)
-                col3.metric("Unmatched", unmatched)
-
-                # Download results
-                output = BytesIO()
-                with pd.ExcelWriter(output, engine='openpyxl') as writer:
-                    hf_name_match_results.to_excel(writer, index=False)
-                output.seek(0)
-
-                st.download_button(
-                    label="Download Matching Results as Excel",
-                    data=output,
-                    file_name="hf_name_matching_results.xlsx",
-                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-                )
+            # Add suggested name column
+            hf_name_match_results = add_suggested_names(hf_name_match_results, threshold)
+
+            # Display results
+            st.write("### Matching Results")
+            st.dataframe(hf_name_match_results)
+
+            # Add summary statistics
+            total_facilities = len(hf_name_match_results)
+            matched = len(hf_name_match_results[hf_name_match_results['Match_Status'] == 'Match'])
+            unmatched = total_facilities - matched
+
+            st.write("### Summary Statistics")
+            col1, col2, col3 = st.columns(3)
+            col1.metric("Total Facilities", total_facilities)
+            col2.metric("Matched", matched)
+            col3.metric("Unmatched", unmatched)
+
+            if use_crosswalk:
+                st.write(f"Names resolved from saved matches: {hf_name_match_results.attrs['crosswalk_hits']}")
+
+            if cached['recall'] is not None:
+                st.write(f"Candidate recall against a full comparison (sample of MFL names): {cached['recall']:.1%}")
+
+            # Download results
+            output = BytesIO()
+            with pd.ExcelWriter(output, engine='openpyxl') as writer:
+                hf_name_match_results.to_excel(writer, index=False)
+            output.seek(0)
+
+            st.download_button(
+                label="Download Matching Results as Excel",
+                data=output,
+                file_name="hf_name_matching_results.xlsx",
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+            )
+        elif cached is not None and not running:
+            st.info("The inputs or settings changed since the last run. Click 'Perform Matching' to update the results.")
 
         if st.button("Start Over"):
+            forget_job(st.session_state.match_job_id)
+            st.query_params.pop('match_job', None)
             st.session_state.step = 1
             st.session_state.master_hf_list = None
             st.session_state.health_facilities_dhis2_list = None
+            st.session_state.match_cache = None
+            st.session_state.match_job_id = None
+            st.experimental_rerun()
+
+        # Poll the running job until it finishes
+        if running:
+            time.sleep(0.5)
             st.experimental_rerun()
 
 if __name__ == "__main__":
@@ -1,11 +1,10 @@
 
 import streamlit as st
-import geopandas as gpd
-import pandas as pd
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 import numpy as np
-from shapely.geometry import Point
+from facilities import AssignmentStore, coordinate_issue_summary, district_facilities_by_chiefdom, facility_points
+from ingest import BOUNDARY_FILE_TYPES, read_boundaries, read_excel
 
 st.set_page_config(layout="wide", page_title="Health Facility Map Generator")
 
@@ -17,28 +16,25 @@ col1, col2 = st.columns(2)
 
 with col1:
     st.header("Upload Shapefiles")
-    shp_file = st.file_uploader("Upload .shp file", type=["shp"], key="shp")
-    shx_file = st.file_uploader("Upload .shx file", type=["shx"], key="shx")
-    dbf_file = st.file_uploader("Upload .dbf file", type=["dbf"], key="dbf")
+    boundary_files = st.file_uploader(
+        "Upload a zipped shapefile, GeoPackage or GeoJSON (or the .shp, .shx and .dbf files)",
+        type=BOUNDARY_FILE_TYPES,
+        accept_multiple_files=True,
+        key="boundaries"
+    )
 
 with col2:
     st.header("Upload Health Facility Data")
     facility_file = st.file_uploader("Upload Excel file (.xlsx)", type=["xlsx"], key="facility")
 
 # Check if all required files are uploaded
-if all([shp_file, shx_file, dbf_file, facility_file]):
+if all([boundary_files, facility_file]):
     try:
-        # Read shapefiles
-        with open("temp.shp", "wb") as f:
-            f.write(shp_file.read())
-        with open("temp.shx", "wb") as f:
-            f.write(shx_file.read())
-        with open("temp.dbf", "wb") as f:
-            f.write(dbf_file.read())
-        shapefile = gpd.read_file("temp.shp")
+        # Read the boundaries from memory (parsed once per upload, then cached)
+        shapefile = read_boundaries(boundary_files)
 
         # Read facility data
-        facility_data = pd.read_excel(facility_file)
+        facility_data = read_excel(facility_file)
 
         # Column selection
         st.header("Coordinate Column Selection")
@@ -84,13 +80,13 @@ if all([shp_file, shx_file, dbf_file, facility_file]):
             show_facility_count = st.checkbox("Show Facility Count", value=True)
             show_chiefdom_name = st.checkbox("Show Chiefdom Name", value=True)
 
-        # Convert facility data to GeoDataFrame
-        geometry = [Point(xy) for xy in zip(facility_data[longitude_col], facility_data[latitude_col])]
-        facilities_gdf = gpd.GeoDataFrame(
-            facility_data, 
-            geometry=geometry,
-            crs="EPSG:4326"
-        )
+        # Convert facility data to GeoDataFrame, flagging bad coordinates
+        facilities_gdf = facility_points(facility_data, longitude_col, latitude_col)
+
+        # Report facilities whose coordinates are missing, swapped or outside the country
+        coordinate_issues = coordinate_issue_summary(facilities_gdf)
+        if coordinate_issues:
+            st.warning(f"Facility coordinates needing attention: {coordinate_issues}")
 
         # Get unique districts from shapefile
         districts = sorted(shapefile['FIRST_DNAM'].unique())
@@ -99,6 +95,13 @@ if all([shp_file, shx_file, dbf_file, facility_file]):
         # Filter shapefile for selected district
         district_shapefile = shapefile[shapefile['FIRST_DNAM'] == selected_district]
         
+        # Assign every facility to its chiefdom once, against all chiefdoms, and
+        # split the selected district's facilities by chiefdom. Assignments are
+        # saved, so reruns (e.g. switching district) and re-uploads only locate
+        # new or moved facilities
+        district_facilities, facilities_by_chiefdom = district_facilities_by_chiefdom(
+            facilities_gdf, shapefile, selected_district, name_col, AssignmentStore())
+
         # Get unique chiefdoms for the selected district
         chiefdoms = sorted(district_shapefile['FIRST_CHIE'].unique())
         
@@ -126,13 +129,8 @@ if all([shp_file, shx_file, dbf_file, facility_file]):
             # Get chiefdom boundary coordinates
             bounds = chiefdom_shapefile.total_bounds
             
-            # Spatial join to get facilities within the chiefdom
-            chiefdom_facilities = gpd.sjoin(
-                facilities_gdf,
-                chiefdom_shapefile,
-                how="inner",
-                predicate="within"
-            )
+            # Facilities within the chiefdom
+            chiefdom_facilities = facilities_by_chiefdom.get(chiefdom, district_facilities.iloc[:0])
             
             if len(chiefdom_facilities) > 0:
                 # Add scatter mapbox trace for facilities
@@ -205,8 +203,8 @@ if all([shp_file, shx_file, dbf_file, facility_file]):
 
         with col10:
             # Export facility data
-            if len(chiefdom_facilities) > 0:
-                csv = chiefdom_facilities.to_csv(index=False)
+            if len(district_facilities) > 0:
+                csv = district_facilities.to_csv(index=False)
                 st.download_button(
                     label="Download Processed Data (CSV)",
                     data=csv,
@@ -0,0 +1,51 @@
+import geopandas as gpd
+import pandas as pd
+from shapely.geometry import box
+
+from facilities import AssignmentStore, district_facilities_by_chiefdom, facility_points, join_chiefdoms
+
+
+def chiefdoms():
+    return gpd.GeoDataFrame({
+        'FIRST_DNAM': ['BO', 'BO', 'KENEMA'],
+        'FIRST_CHIE': ['Badjia', 'Bagbo', 'Dodo'],
+    }, geometry=[box(-12, 7, -11.5, 7.5), box(-11.5, 7, -11, 7.5), box(-11, 7, -10.5, 7.5)], crs='EPSG:4326')
+
+
+def workbook(**columns):
+    return pd.DataFrame({'hf': ['a', 'b', 'c', 'd'], 'w_long': [-11.8, -11.7, -11.2, -10.7],
+                         'w_lat': [7.2, 7.3, 7.2, 7.2], **columns})
+
+
+def test_facilities_split_by_chiefdom():
+    district_facilities, by_chiefdom = district_facilities_by_chiefdom(facility_points(workbook()), chiefdoms(), 'BO')
+    assert district_facilities['hf'].tolist() == ['a', 'b', 'c']
+    assert {name: frame['hf'].tolist() for name, frame in by_chiefdom.items()} == {'Badjia': ['a', 'b'], 'Bagbo': ['c']}
+
+
+def test_workbook_with_chiefdom_name_columns():
+    # A workbook carrying its own (here wrong) district and chiefdom names
+    points = facility_points(workbook(FIRST_DNAM=['x'] * 4, FIRST_CHIE=['y'] * 4))
+    assert 'FIRST_DNAM' not in join_chiefdoms(points, chiefdoms()).columns
+
+    district_facilities, by_chiefdom = district_facilities_by_chiefdom(points, chiefdoms(), 'BO')
+    assert district_facilities['hf'].tolist() == ['a', 'b', 'c']
+    assert district_facilities['FIRST_DNAM_right'].tolist() == ['BO', 'BO', 'BO']
+    assert {name: frame['hf'].tolist() for name, frame in by_chiefdom.items()} == {'Badjia': ['a', 'b'], 'Bagbo': ['c']}
+
+
+def test_split_with_saved_assignments(tmp_path):
+    store = AssignmentStore(str(tmp_path / 'assignments.sqlite'))
+    points = facility_points(workbook(FIRST_CHIE=['y'] * 4))
+    first = district_facilities_by_chiefdom(points, chiefdoms(), 'KENEMA', 'hf', store)
+    second = district_facilities_by_chiefdom(points, chiefdoms(), 'KENEMA', 'hf', store)
+    assert first[0]['hf'].tolist() == second[0]['hf'].tolist() == ['d']
+    assert list(second[1]) == ['Dodo']
+
+
+def test_saved_assignments_are_capped(tmp_path):
+    store = AssignmentStore(str(tmp_path / 'assignments.sqlite'), max_rows=2)
+    store.save('v1', [('a', 0, 0, 1), ('b', 0, 0, 2)])
+    store.save('v2', [('c', 0, 0, 3)])
+    assert len(store) == 2
+    assert store.lookup('v2', [('c', 0, 0)]) == {('c', 0.0, 0.0): 3}
@@ -0,0 +1,133 @@
+import numpy as np
+import pandas as pd
+from rapidfuzz.distance import JaroWinkler
+from scipy.optimize import linear_sum_assignment
+
+from crosswalk import CrosswalkStore
+from name_matching import MatchingEngine, calculate_match, reclassify
+
+SYLLABLES = ['ba', 'bo', 'gba', 'ka', 'ke', 'koi', 'la', 'lu', 'ma', 'mbo', 'nde', 'pu', 'se', 'to', 'wa', 'yi']
+
+
+def facility_names(n, seed=0):
+    rng = np.random.default_rng(seed)
+    names = set()
+    while len(names) < n:
+        word = ''.join(rng.choice(SYLLABLES, rng.integers(2, 5))).title()
+        names.add(f"{word} {rng.choice(['CHC', 'CHP', 'MCHP'])}")
+    return sorted(names)
+
+
+def with_typos(names, seed=1):
+    # Drop or double one character of every name
+    rng = np.random.default_rng(seed)
+    typos = []
+    for name in names:
+        i = rng.integers(1, len(name) - 1)
+        typos.append(name[:i] + name[i + 1:] if rng.random() < 0.5 else name[:i] + name[i] + name[i:])
+    return typos
+
+
+def full_scan(queries, choices):
+    # Score of every pair, one at a time
+    return np.array([[JaroWinkler.normalized_similarity(q, c) * 100 for c in choices] for q in queries])
+
+
+def test_best_matches_agree_with_full_scan():
+    choices = facility_names(200)
+    queries = with_typos(choices[::3]) + ['Nowhere Hospital']
+    positions, scores = MatchingEngine(chunk_size=16).best_matches(queries, choices)
+    expected = full_scan(queries, choices)
+    assert positions.tolist() == expected.argmax(axis=1).tolist()
+    assert np.allclose(scores, expected.max(axis=1))
+
+
+def test_top_k_recall():
+    choices = facility_names(400)
+    queries = with_typos(choices[::4])
+    engine = MatchingEngine(top_k=20)
+    positions, scores = engine.best_matches(queries, choices)
+    best = full_scan(queries, choices).max(axis=1)
+    # Retrieval only ever misses candidates, and rarely the best one
+    assert (scores <= best + 1e-9).all()
+    assert np.mean(np.isclose(scores, best)) >= 0.95
+    assert engine.stats['pairs_scored'] < len(queries) * len(choices)
+    assert engine.candidate_recall(queries, choices) >= 0.95
+
+
+def test_blocked_with_fallback_agrees_with_full_scan():
+    choices = facility_names(120)
+    districts = ['Bo', 'Kenema', 'Kono']
+    dhis2 = pd.DataFrame({'hf': choices, 'district': [districts[i % 3] for i in range(len(choices))]})
+    # Two in three names are listed under another district in the MFL
+    queries = with_typos(choices[::2])
+    mfl = pd.DataFrame({'name': queries, 'district': [districts[i % 3] for i in range(len(queries))]})
+    threshold = 90
+
+    scores = full_scan(queries, choices)
+    in_block = mfl['district'].to_numpy()[:, None] == dhis2['district'].to_numpy()[None, :]
+    blocked = np.where(in_block, scores, -1)
+    expected = np.where(blocked.max(axis=1) >= threshold, blocked.argmax(axis=1), scores.argmax(axis=1))
+
+    results = calculate_match(mfl, dhis2, 'name', 'hf', threshold, block_on=[('district', 'district')])
+    matched = results[results['HF_Name_in_MFL'].notna()]
+    assert matched['HF_Name_in_DHIS2'].tolist() == [choices[j] for j in expected]
+
+    results = calculate_match(mfl, dhis2, 'name', 'hf', threshold, block_on=[('district', 'district')],
+                              national_fallback=False)
+    matched = results[results['HF_Name_in_MFL'].notna()]
+    assert (matched['Match_Score'].to_numpy() == np.round(blocked.max(axis=1), 2)).all()
+
+
+def test_exact_match_outside_block_needs_fallback():
+    mfl = pd.DataFrame({'name': ['Kania MCHP'], 'district': ['Bo']})
+    dhis2 = pd.DataFrame({'hf': ['Kania MCHP', 'Gbaama CHP'], 'district': ['Kenema', 'Bo']})
+    blocked = calculate_match(mfl, dhis2, 'name', 'hf', 90, block_on=[('district', 'district')],
+                              national_fallback=False)
+    assert blocked.loc[0, 'Match_Status'] == 'Unmatch'
+    assert blocked.loc[0, 'HF_Name_in_DHIS2'] != 'Kania MCHP'
+    national = calculate_match(mfl, dhis2, 'name', 'hf', 90, block_on=[('district', 'district')])
+    assert national.loc[0, ['HF_Name_in_DHIS2', 'Match_Score', 'Match_Status']].tolist() == ['Kania MCHP', 100, 'Match']
+
+
+def test_one_to_one_is_unique_and_optimal():
+    choices = facility_names(8, seed=3)
+    # Several MFL names compete for the same DHIS2 facilities
+    queries = with_typos(choices[:4]) + with_typos(choices[:4], seed=2) + [choices[5]]
+    threshold = 80
+    results = calculate_match(pd.DataFrame({'name': queries}), pd.DataFrame({'hf': choices}), 'name', 'hf',
+                              threshold, one_to_one=True)
+    matched = results[results['Match_Status'] == 'Match']
+    assert matched['HF_Name_in_DHIS2'].is_unique
+
+    # The best total score over all one-to-one assignments of the full scan
+    scores = full_scan(queries, choices)
+    weights = np.where(scores >= threshold, scores, 0)
+    rows, cols = linear_sum_assignment(weights, maximize=True)
+    assert np.isclose(matched['Match_Score'].sum(), weights[rows, cols].sum(), atol=0.1)
+
+
+def test_crosswalk_pairs_below_threshold_are_rescored(tmp_path):
+    crosswalk = CrosswalkStore(str(tmp_path / 'crosswalk.sqlite'))
+    mfl = pd.DataFrame({'name': ['Gbangbatoke']})
+    first = calculate_match(mfl, pd.DataFrame({'hf': ['Gbaama']}), 'name', 'hf', 50, crosswalk=crosswalk)
+    assert first.loc[0, 'Match_Status'] == 'Match'
+
+    dhis2 = pd.DataFrame({'hf': ['Gbaama', 'Gbangbatok']})
+    second = calculate_match(mfl, dhis2, 'name', 'hf', 90, crosswalk=crosswalk)
+    assert second.attrs['crosswalk_hits'] == 0
+    assert second.loc[0, 'HF_Name_in_DHIS2'] == 'Gbangbatok'
+    third = calculate_match(mfl, dhis2, 'name', 'hf', 90, crosswalk=crosswalk)
+    assert third.attrs['crosswalk_hits'] == 1
+    assert third.loc[0, 'HF_Name_in_DHIS2'] == 'Gbangbatok'
+    # Saved pairs belong to the scorer that found them
+    other = calculate_match(mfl, dhis2, 'name', 'hf', 90, engine=MatchingEngine('indel'), crosswalk=crosswalk)
+    assert other.attrs['crosswalk_hits'] == 0
+
+
+def test_reclassify_matches_a_fresh_run():
+    choices = facility_names(60)
+    mfl = pd.DataFrame({'name': with_typos(choices[::2])})
+    dhis2 = pd.DataFrame({'hf': choices})
+    results = reclassify(calculate_match(mfl, dhis2, 'name', 'hf', 70), 95)
+    pd.testing.assert_frame_equal(results, calculate_match(mfl, dhis2, 'name', 'hf', 95))